@@ -22,7 +22,6 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 import warnings
 warnings.filterwarnings('ignore')
 
-from tqdm.autonotebook import tqdm
 from sdg_util import *
 import pandas as pd
 import torch
@@ -35,14 +34,9 @@ tokenizer = tokenizers.BertWordPieceTokenizer(
     lowercase=True
 )
 
-model_config = BertConfig.from_pretrained('bert-base-uncased')
-model_config.output_hidden_states = True
-model = SDGModel(conf=model_config)
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-model.load_state_dict(torch.load('../models/model_2.bin', map_location=device)['model_state_dict'])
-
-model.eval()
-model.to(device)
+# on CPU, pass precision='int8' to load_model for faster (dynamically quantized) inference
+model = load_model('../models/model_2.bin', device)
 
 
 #SAMPLE DATA
@@ -414,38 +408,21 @@ df = pd.DataFrame()
 
 for id in sample_data:
     value = sample_data[id]
+    # process_text(value, tokenizer, max_tokens=512) splits into chunks that fit the model exactly
+    # instead of 400 words; pass input_ids=df.input_ids to process_list_of_text to reuse their tokens
     df_this_text = process_text(value)
     df_this_text['id'] = id
     df = pd.concat([df,df_this_text]).reset_index(drop=True)
 
 #INFERENCE
 
-df['sdg'] = process_list_of_text(df.text, model, tokenizer, device)
-
-for i in range(17):
-    df["sdg_%i"%(i+1)] = df["sdg"].apply(lambda x: x[i])
-
-df['id_copy'] = df['id']
-df_agg = df.groupby([
-                    'id',
-                    'error',
-                    ]
-                )["id_copy"].count().reset_index().rename({
-                    "id_copy": "num_chunks",
-                    "error": "parsing_error"
-                    }, axis=1)
-df_agg["num_valid_chunks"] = 0
-df_agg["document_top_sdg"] = ""
-
-for c in SDG_COLS:
-    df_agg[c] = 0
-
-for uuid in tqdm(df.id.unique()):
-    df_sdg_smooth = smoothen_sdg_values(df[df.id==uuid][SDG_COLS], window_size=5)
-    scores, top_sdg_index, num_valid_chunks = aggregated_sdg_score(df_sdg_smooth, CONFIDENCE_LEVEL=0.5)
-    df_agg.loc[df_agg.id==uuid, SDG_COLS] = scores
-    df_agg.loc[df_agg.id==uuid, "document_top_sdg"] = SDG_GOALS[top_sdg_index]
-    df_agg.loc[df_agg.id==uuid, "num_valid_chunks"] = num_valid_chunks
+# one row of 17 scores per chunk, in the order of df; repeated chunks are only scored once
+sdg_scores = process_list_of_text(df.text, model, tokenizer, device, as_matrix=True, deduplicate=True)
+df[SDG_COLS] = pd.DataFrame(sdg_scores, index=df.index)
+
+#AGGREGATION
+# the chunks of every document are contiguous in df, so all documents are aggregated at once
+df_agg = aggregate_chunks(df, sdg_scores, window_size=5, CONFIDENCE_LEVEL=0.5)
 
 print(df_agg.head())
 
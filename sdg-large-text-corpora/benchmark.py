@@ -0,0 +1,176 @@
+"""
+Benchmark of the corpus pipeline: chunking, tokenization, inference and aggregation
+
+Runs the steps of index_corpus.py batch by batch over a synthetic corpus (see
+benchmark_chunking.py) or over the given input files, and reports per step the texts and tokens
+per second, the p50 and p99 latency per batch of documents and the peak RSS. The results are
+written to a JSON file; with --compare the throughput and latency are compared with an earlier
+run. sdg-webservice/benchmark.py measures /sdg in the same format.
+
+The fine-tuned model_2.bin is only a Git LFS pointer in a fresh checkout. When it is not
+available (or with --tiny) the inference runs on a randomly initialised SDGModel with a small
+Bert configuration, so the benchmark works offline; its scores are meaningless, but the rest of
+the pipeline does exactly the same work.
+
+Usage:
+    python benchmark.py [--documents 500] [--tiny] [--output results.json] [--compare old.json] [inputs ...]
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Bijan Ranjbar (MyDataExpert)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import argparse
+import json
+import platform
+import time
+
+from sdg_util import *
+from benchmark_chunking import synthetic_corpus
+from index_corpus import aggregate_batch, chunk_documents, iterate_documents
+from parallel_inference import available_cores
+from benchmark_support import PeakRSS, compare, is_checkpoint, summarise
+
+
+def tiny_model(device, vocab_size, seed=0):
+    """
+    a randomly initialised SDGModel with a small Bert configuration (2 layers of 128)
+    """
+    torch.manual_seed(seed)
+    model_config = BertConfig(
+        vocab_size=vocab_size, hidden_size=128, num_hidden_layers=2, num_attention_heads=2, intermediate_size=512
+    )
+    model = SDGModel(conf=model_config)
+    model.eval()
+    model.to(device)
+    return model
+
+
+def run_step(name, batches, step, texts, tokens, unit):
+    """
+    runs step(batch) for every batch, timing every call; returns the results of the calls and
+    the summary of the step
+    """
+    results = []
+    latencies = []
+    with PeakRSS() as rss:
+        for batch in batches:
+            start = time.perf_counter()
+            results.append(step(batch))
+            latencies.append(time.perf_counter() - start)
+    return results, summarise(name, latencies, texts, tokens, rss.peak, unit)
+
+
+def tokenize(texts, tokenizer):
+    """
+    the input pipeline of process_list_of_text: tokenizes the texts and pads them into batches
+    of similar length
+    """
+    dataset = SDGDataset(abstract=texts, tokenizer=tokenizer, dynamic_padding=True)
+    sampler = LengthSortedBatchSampler(dataset.token_lengths(), config.VALID_BATCH_SIZE)
+    return [pad_batch([dataset[i] for i in indices]) for indices in sampler]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chunking, tokenization, inference and aggregation")
+    parser.add_argument("inputs", nargs="*", help="text files, .jsonl files (optionally gzipped) or directories")
+    parser.add_argument("--documents", type=int, default=500, help="number of synthetic documents")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-documents", type=int, default=16, help="documents per batch")
+    parser.add_argument("--batch-size", type=int, default=config.VALID_BATCH_SIZE, help="chunks per forward pass")
+    parser.add_argument("--model", default="../models/model_2.bin")
+    parser.add_argument("--model-config", default=config.BERT_CONFIG_PATH)
+    parser.add_argument("--vocab", default=config.VOCAB_PATH)
+    parser.add_argument("--tiny", action="store_true",
+                        help="use a randomly initialised small model, also when --model is available")
+    parser.add_argument("--output", default="benchmark-%s.json" % time.strftime("%Y%m%d-%H%M%S"))
+    parser.add_argument("--compare", help="results of an earlier run")
+    args = parser.parse_args()
+
+    config.NUM_WORKERS = 0
+    config.VALID_BATCH_SIZE = args.batch_size
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    tokenizer = tokenizers.BertWordPieceTokenizer(args.vocab, lowercase=True)
+
+    if args.inputs:
+        documents = list(iterate_documents(args.inputs))
+    else:
+        documents = [("doc%i" % i, text) for i, text in enumerate(synthetic_corpus(args.documents, args.seed))]
+    batches = [documents[start:start + args.batch_documents] for start in range(0, len(documents), args.batch_documents)]
+
+    if args.tiny or not is_checkpoint(args.model):
+        if not args.tiny:
+            print("%s is not available (a Git LFS pointer?), using a randomly initialised small model" % args.model)
+        model = tiny_model(device, tokenizer.get_vocab_size(), args.seed)
+        model_name = "tiny"
+    else:
+        model = load_model(args.model, device, config_path=args.model_config, torchscript_path="")
+        model_name = args.model
+
+    # the tokens of the chunks as the model sees them, for the tokens per second of every step
+    frames = [chunk_documents(batch) for batch in batches]
+    chunks = [text for df in frames for text in df.text]
+    tokens = int(sum(min(len(encoding.ids), config.MAX_LEN) for encoding in tokenizer.encode_batch(chunks)))
+    print("%i documents, %i chunks, %i tokens, model %s" % (len(documents), len(chunks), tokens, model_name))
+
+    results = {}
+    frames, results["chunking"] = run_step(
+        "chunking", batches, chunk_documents, len(documents), tokens, "documents")
+    _, results["token_chunking"] = run_step(
+        "token_chunking", batches, lambda batch: chunk_documents(batch, tokenizer, config.MAX_LEN),
+        len(documents), tokens, "documents")
+    _, results["tokenization"] = run_step(
+        "tokenization", frames, lambda df: tokenize(list(df.text), tokenizer), len(chunks), tokens, "chunks")
+    outs, results["inference"] = run_step(
+        "inference", frames,
+        lambda df: process_list_of_text(df.text, model, tokenizer, device, as_matrix=True, deduplicate=True),
+        len(chunks), tokens, "chunks")
+    _, results["aggregation"] = run_step(
+        "aggregation", list(zip(frames, outs, batches)),
+        lambda batch: aggregate_batch(batch[0], batch[1], [document_id for document_id, _ in batch[2]]),
+        len(chunks), tokens, "chunks")
+
+    report = {
+        "benchmark": "corpus",
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "model": model_name,
+        "hardware": {
+            "cores": len(available_cores()),
+            "machine": platform.machine(),
+            "device": device.type,
+            "torch_threads": torch.get_num_threads(),
+            "torch": torch.__version__,
+        },
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "corpus": {
+            "documents": len(documents),
+            "characters": sum(len(text) for _, text in documents),
+            "chunks": len(chunks),
+            "tokens": tokens,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("results written to %s" % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
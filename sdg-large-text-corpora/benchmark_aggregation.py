@@ -0,0 +1,169 @@
+"""
+Benchmark of the aggregation of chunk scores into document scores in sdg_util.py
+
+Compares aggregate_documents and aggregate_chunks with the original implementation, which calls
+smoothen_sdg_values and aggregated_sdg_score for every document, and checks that both produce the
+same scores, top SDGs and numbers of valid chunks. The synthetic scores include the edge cases:
+empty documents, documents with fewer chunks than the window, ERROR_TEXT placeholders (scored
+zero) and chunks without scores (NaN), rounded to 4 decimals like the model output so that some
+smoothed scores are exactly at the confidence level.
+
+Usage:
+    python benchmark_aggregation.py [--documents 500] [--window-sizes 1 3 5 8]
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Bijan Ranjbar (MyDataExpert)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import argparse
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from sdg_util import (ERROR_TEXT, SDG_COLS, SDG_GOALS, aggregate_chunks, aggregate_documents, aggregated_sdg_score,
+                      smoothen_sdg_values)
+
+
+def reference_aggregate_documents(sdg_scores, offsets, window_size=5, CONFIDENCE_LEVEL=0.5):
+    """
+    the original implementation of aggregate_documents: one document at a time
+    """
+    scores, top_sdg_index, num_valid_chunks = [], [], []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        df_sdg_smooth = smoothen_sdg_values(pd.DataFrame(sdg_scores[start:end], columns=SDG_COLS), window_size=window_size)
+        document_scores, document_top_sdg, document_valid_chunks = aggregated_sdg_score(
+            df_sdg_smooth, CONFIDENCE_LEVEL=CONFIDENCE_LEVEL)
+        scores.append(document_scores)
+        top_sdg_index.append(document_top_sdg)
+        num_valid_chunks.append(document_valid_chunks)
+    return np.array(scores, dtype=np.float64).reshape(-1, 17), np.array(top_sdg_index), np.array(num_valid_chunks)
+
+
+def reference_aggregate_chunks(df, sdg_scores, window_size=5, CONFIDENCE_LEVEL=0.5):
+    """
+    the original aggregation of basic_usage.py: a groupby for the chunk counts and a loop over
+    the documents for the scores
+    """
+    df = df.copy()
+    df[SDG_COLS] = pd.DataFrame(sdg_scores, index=df.index)
+    df['id_copy'] = df['id']
+    df_agg = df.groupby(['id', 'error'], sort=False)["id_copy"].count().reset_index().rename({
+        "id_copy": "num_chunks",
+        "error": "parsing_error"
+    }, axis=1)
+    df_agg["num_valid_chunks"] = 0.0
+    df_agg["document_top_sdg"] = ""
+    for c in SDG_COLS:
+        df_agg[c] = 0.0
+
+    for uuid in df.id.unique():
+        df_sdg_smooth = smoothen_sdg_values(df[df.id == uuid][SDG_COLS], window_size=window_size)
+        scores, top_sdg_index, num_valid_chunks = aggregated_sdg_score(df_sdg_smooth, CONFIDENCE_LEVEL=CONFIDENCE_LEVEL)
+        df_agg.loc[df_agg.id == uuid, SDG_COLS] = scores
+        df_agg.loc[df_agg.id == uuid, "document_top_sdg"] = SDG_GOALS[top_sdg_index]
+        df_agg.loc[df_agg.id == uuid, "num_valid_chunks"] = num_valid_chunks
+    return df_agg
+
+
+def synthetic_scores(num_documents, seed=0, max_chunks=12):
+    """
+    chunk scores of documents of 0 to max_chunks chunks, with ERROR_TEXT placeholders, chunks
+    without scores and scores at the confidence level
+    returns the chunk data frame (with id, text and error columns), its scores and the document
+    offsets (empty documents only appear in the offsets, a chunk data frame cannot hold them)
+    """
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(0, max_chunks + 1, num_documents)
+    error = np.zeros(lengths.sum(), dtype=bool)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    # scores near 0 or 1 like those of the model, rounded to 4 decimals
+    scores = np.round(rng.beta(0.3, 0.6, (lengths.sum(), 17)), 4)
+    scores[rng.rand(len(scores)) < 0.1] = 0.5
+    scores[rng.rand(len(scores)) < 0.02] = np.nan
+    # single chunk documents that could not be parsed get zero scores (see process_list_of_text)
+    single = offsets[:-1][(lengths == 1) & (rng.rand(num_documents) < 0.5)]
+    scores[single] = 0.0
+    error[single] = True
+
+    document = np.repeat(np.arange(num_documents), lengths)
+    df = pd.DataFrame({
+        "id": ["doc%i" % d for d in document],
+        "text": np.where(error, ERROR_TEXT, "chunk"),
+        "error": error,
+    })
+    return df, scores, offsets
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def check_documents(reference, result, window_size):
+    for name, expected, actual in zip(("scores", "top SDG", "valid chunks"), reference, result):
+        expected = np.asarray(expected, dtype=np.float64)
+        actual = np.asarray(actual, dtype=np.float64)
+        differs = (expected != actual) & ~(np.isnan(expected) & np.isnan(actual))
+        if differs.any():
+            rows = np.flatnonzero(differs.reshape(len(differs), -1).any(axis=1))
+            raise AssertionError("aggregate_documents (window size %i) produced other %s than the original "
+                                 "implementation for documents %s" % (window_size, name, rows[:10].tolist()))
+
+
+def check_chunks(reference, result, window_size):
+    columns = ["id", "parsing_error", "num_chunks", "num_valid_chunks", "document_top_sdg"] + SDG_COLS
+    try:
+        pd.testing.assert_frame_equal(reference[columns], result[columns], check_dtype=False, check_exact=True)
+    except AssertionError as e:
+        raise AssertionError("aggregate_chunks (window size %i) produced other aggregates than the original "
+                             "implementation: %s" % (window_size, e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the aggregation of chunk scores into document scores")
+    parser.add_argument("--documents", type=int, default=500, help="number of synthetic documents")
+    parser.add_argument("--window-sizes", type=int, nargs="+", default=[1, 3, 5, 8])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    df, scores, offsets = synthetic_scores(args.documents, args.seed)
+    print("%i documents (%i empty), %i chunks" % (args.documents, np.sum(np.diff(offsets) == 0), len(scores)))
+
+    # the original implementation divides 0 by 0 for documents without valid chunks
+    warnings.filterwarnings("ignore", category=RuntimeWarning)
+    for window_size in args.window_sizes:
+        reference, reference_time = timed(reference_aggregate_documents, scores, offsets, window_size=window_size)
+        result, fast_time = timed(aggregate_documents, scores, offsets, window_size=window_size)
+        print("window %i, aggregate_documents: original %7.3fs, vectorised %7.3fs (%.1fx)" % (
+            window_size, reference_time, fast_time, reference_time / fast_time))
+        check_documents(reference, result, window_size)
+
+        reference, reference_time = timed(reference_aggregate_chunks, df, scores, window_size=window_size)
+        result, fast_time = timed(aggregate_chunks, df, scores, window_size=window_size)
+        print("window %i, aggregate_chunks:    original %7.3fs, vectorised %7.3fs (%.1fx)" % (
+            window_size, reference_time, fast_time, reference_time / fast_time))
+        check_chunks(reference, result, window_size)
+
+    print("all aggregates identical to the original implementation")
+
+
+if __name__ == "__main__":
+    main()
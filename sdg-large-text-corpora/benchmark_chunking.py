@@ -0,0 +1,124 @@
+"""
+Benchmark of the text cleaning and chunking in sdg_util.py
+
+Compares split_to_chunks with the original regular expression based implementation (and checks
+that both produce exactly the same chunks), and runs split_texts_to_chunks in process pools.
+Without inputs a synthetic corpus is generated from the probe texts.
+
+Usage:
+    python benchmark_chunking.py [--processes 1 4 8] [corpus_dir/ documents.jsonl.gz ...]
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Bijan Ranjbar (MyDataExpert)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import argparse
+import multiprocessing
+import random
+import re
+import time
+
+from index_corpus import iterate_documents
+from sdg_util import PROBE_TEXTS, split_texts_to_chunks
+
+
+def reference_split_to_chunks(text, max_words=400, min_letters=5):
+    """
+    the original implementation of split_to_chunks
+    """
+    text_list = []
+    this_text = ""
+    this_text_length = 0
+    for i, t in enumerate(text.split("\n")):
+
+        if len(t) > min_letters:
+            t_clean = re.sub('[^0-9a-zA-Z.&!,()+\']', ' ', t)
+            t_clean = t_clean.replace("...","").replace(" . . ","")
+            this_text_length = this_text_length + len(t_clean.split(" "))
+            if this_text_length <= max_words:
+                this_text += t_clean + " "
+            else:
+                text_list.append(this_text.strip())
+                this_text = t_clean + " "
+                this_text_length = 0
+
+    if len(this_text) > 1:
+        text_list.append(this_text.strip())
+
+    return [t for t in text_list if t]
+
+
+def synthetic_corpus(num_documents, seed=0):
+    """
+    documents of random length built from the probe texts, with short lines, symbols and some
+    non-ASCII characters like in scraped web pages
+    """
+    rng = random.Random(seed)
+    extras = ["", "", "", "...", " . . ", " – ", "“quoted”", "café", "€ 10", "\t", "***"]
+    documents = []
+    for _ in range(num_documents):
+        lines = []
+        for _ in range(rng.randint(5, 400)):
+            if rng.random() < 0.2:
+                lines.append(rng.choice(["Menu", "Home", "Share", "", "Please sign the petition here"]))
+            else:
+                lines.append(rng.choice(PROBE_TEXTS) + rng.choice(extras) + rng.choice(PROBE_TEXTS))
+        documents.append("\n".join(lines))
+    return documents
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the text cleaning and chunking")
+    parser.add_argument("inputs", nargs="*", help="text files, .jsonl files (optionally gzipped) or directories")
+    parser.add_argument("--documents", type=int, default=2000, help="number of synthetic documents")
+    parser.add_argument("--processes", type=int, nargs="+", default=[2, multiprocessing.cpu_count()])
+    args = parser.parse_args()
+
+    if args.inputs:
+        texts = [text for _, text in iterate_documents(args.inputs)]
+    else:
+        texts = synthetic_corpus(args.documents)
+    size = sum(len(text) for text in texts) / 1e6
+    print("%i documents, %.1f million characters" % (len(texts), size))
+
+    reference, reference_time = timed(lambda: [reference_split_to_chunks(text) for text in texts])
+    print("original split_to_chunks:      %7.2fs (%.1f MB/s)" % (reference_time, size / reference_time))
+
+    chunks, fast_time = timed(split_texts_to_chunks, texts)
+    print("split_to_chunks:               %7.2fs (%.1f MB/s, %.1fx)" % (fast_time, size / fast_time, reference_time / fast_time))
+    if chunks != reference:
+        raise AssertionError("split_to_chunks produced other chunks than the original implementation")
+
+    for processes in args.processes:
+        with multiprocessing.Pool(processes) as pool:
+            chunks, pool_time = timed(split_texts_to_chunks, texts, pool)
+        print("split_texts_to_chunks, %3i processes: %7.2fs (%.1f MB/s, %.1fx)" % (
+            processes, pool_time, size / pool_time, reference_time / pool_time))
+        if chunks != reference:
+            raise AssertionError("split_texts_to_chunks produced other chunks than the original implementation")
+
+    print("all chunks identical to the original implementation")
+
+
+if __name__ == "__main__":
+    main()
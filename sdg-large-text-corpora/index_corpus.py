@@ -0,0 +1,421 @@
+"""
+Command line tool that indexes the SDGs of a large corpus of documents
+
+Documents are streamed from text files (one document per file) or JSON lines files (one
+document per line), optionally gzipped, and processed in batches: chunking, inference and
+aggregation. The results are appended to the output directory after every batch, together
+with a checkpoint, so an interrupted run continues where it stopped when started again with
+the same arguments (changing the inputs or the aggregation settings in between is not detected).
+
+With --from-tokens the chunks are read from a token shard written by tokenize_corpus.py instead,
+which skips the cleaning, chunking and tokenizing when the same corpus is scored again.
+
+Usage:
+    python index_corpus.py --output results/ corpus_dir/ more_documents.jsonl.gz
+    python index_corpus.py --output results/ --from-tokens shard/
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Bijan Ranjbar (MyDataExpert)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import warnings
+warnings.filterwarnings('ignore')
+
+import argparse
+import csv
+import gzip
+import json
+import multiprocessing
+import os
+
+from tqdm.autonotebook import tqdm
+from sdg_util import *
+from parallel_inference import ParallelPredictor
+from profiling import Profiler
+from tuning import load_tuned
+from score_store import ScoreStore, FeatureStore
+from token_shards import TokenShard
+import pandas as pd
+import torch
+
+
+DOCUMENTS_FILE = "documents.csv"
+CHUNK_SCORES_DIR = "chunk_scores"
+FEATURES_DIR = "features"
+CHECKPOINT_FILE = "checkpoint.json"
+
+DOCUMENT_COLUMNS = ["id", "parsing_error", "num_chunks", "num_valid_chunks", "document_top_sdg"] + SDG_COLS
+
+
+def open_text(path):
+    """
+    opens a (possibly gzipped) text file
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+def list_input_files(paths):
+    """
+    expands the input paths (files and directories) into a sorted list of files, so the order
+    in which documents are read is the same on every run
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+    return files
+
+
+def iterate_documents(paths, id_field="id", text_field="text"):
+    """
+    yields (document id, text) for every document in the input files
+    .jsonl(.gz) files hold one JSON document per line, any other file is a single document
+    whose id is its path
+    """
+    for path in list_input_files(paths):
+        name = path[:-3] if path.endswith(".gz") else path
+        with open_text(path) as f:
+            if name.endswith(".jsonl"):
+                for line_number, line in enumerate(f):
+                    if not line.strip():
+                        continue
+                    document = json.loads(line)
+                    yield str(document.get(id_field, "%s:%i" % (path, line_number))), document.get(text_field) or ""
+            else:
+                yield path, f.read()
+
+
+def chunk_documents(documents, tokenizer=None, max_tokens=None, overlap=0, pool=None):
+    """
+    chunks a list of (document id, text) into a data frame with one row per chunk
+    with max_tokens the documents are split into chunks of at most max_tokens tokens (whose ids
+    are kept in the input_ids column), otherwise into chunks of at most 400 words (in the
+    multiprocessing pool, when given)
+    """
+    if max_tokens:
+        frames = [process_text(text, tokenizer, max_tokens=max_tokens, overlap=overlap) for _, text in documents]
+    else:
+        texts = [text for _, text in documents]
+        frames = [
+            process_text(text, text_list=text_list)
+            for text, text_list in zip(texts, split_texts_to_chunks(texts, pool))
+        ]
+    return pd.concat(
+        [df_doc.assign(id=document_id, document=number) for number, ((document_id, _), df_doc) in enumerate(zip(documents, frames))],
+        ignore_index=True
+    )
+
+
+def text_batches(paths, id_field, text_field, batch_documents, skip, tokenizer, max_tokens=None, overlap=0, pool=None):
+    """
+    yields (document ids, chunk data frame, None) for every batch of documents in the input files,
+    skipping the first `skip` documents
+    """
+    batch = []
+    for number, document in enumerate(iterate_documents(paths, id_field, text_field)):
+        if number < skip:
+            continue
+        batch.append(document)
+        if len(batch) >= batch_documents:
+            yield [document_id for document_id, _ in batch], chunk_documents(batch, tokenizer, max_tokens, overlap, pool), None
+            batch = []
+    if batch:
+        yield [document_id for document_id, _ in batch], chunk_documents(batch, tokenizer, max_tokens, overlap, pool), None
+
+
+def chunk_frame(chunks, document_ids, first_document):
+    """
+    the chunk data frame (like chunk_documents makes, without texts) of a slice of a chunk index
+    (see score_store.py) that starts at document number first_document
+    """
+    documents = chunks["document"] - first_document
+    return pd.DataFrame({
+        "id": [document_ids[i] for i in documents],
+        "document": documents,
+        "chunk_order": chunks["chunk_order"],
+        "error": chunks["error"],
+    })
+
+
+def aggregate_batch(df, outs, document_ids, window_size=5, confidence_level=0.5):
+    """
+    aggregates the chunk scores of a batch of documents (see chunk_documents) per document number,
+    as ids need not be unique in a corpus, and labels every document with its id
+    """
+    df_agg = aggregate_chunks(
+        df, outs, window_size=window_size, CONFIDENCE_LEVEL=confidence_level, document_column="document"
+    )
+    df_agg["id"] = [document_ids[number] for number in df_agg.id]
+    return df_agg
+
+
+def shard_batches(shard, batch_documents, skip):
+    """
+    yields (document ids, chunk data frame, token ids) for every batch of documents in a token
+    shard (see token_shards.py), skipping the first `skip` documents
+    """
+    for start in range(skip, len(shard.document_ids), batch_documents):
+        stop = min(start + batch_documents, len(shard.document_ids))
+        first_chunk, last_chunk = shard.document_offsets[start], shard.document_offsets[stop]
+        document_ids = shard.document_ids[start:stop]
+        df = chunk_frame(shard.chunks[first_chunk:last_chunk], document_ids, start)
+        yield document_ids, df, shard.token_ids(first_chunk, last_chunk)
+
+
+def score_chunks(df, document_ids, model, tokenizer, device, window_size, confidence_level, input_ids=None,
+                 return_features=False, score_cache=None):
+    """
+    scores the chunks of a batch of documents (see chunk_documents) and aggregates them
+    input_ids can hold the token ids of the chunks from a token shard, the chunks then need no text
+    a score_cache (see ScoreCache) answers the chunks that were scored in earlier batches
+    returns the chunk scores (chunks x 17), the document data frame and, with return_features, the
+    CLS features of the chunks (None otherwise)
+    """
+    features = None
+    if input_ids is None:
+        input_ids = df.input_ids if "input_ids" in df else None
+        results = process_list_of_text(
+            df.text, model, tokenizer, device, as_matrix=True, input_ids=input_ids, deduplicate=True,
+            return_features=return_features, score_cache=score_cache
+        )
+        outs, features = results if return_features else (results, None)
+    else:
+        # without texts the ERROR_TEXT placeholders are recognised by their error flag
+        outs = np.zeros((len(df), 17), dtype=np.float32)
+        if return_features:
+            features = np.zeros((len(df), 2 * model.nb_features), dtype=np.float32)
+        valid = np.flatnonzero(~df.error.values)
+        if len(valid):
+            results = process_list_of_text(
+                None, model, tokenizer, device, as_matrix=True, input_ids=input_ids.subset(valid), deduplicate=True,
+                return_features=return_features, score_cache=score_cache
+            )
+            if return_features:
+                outs[valid], features[valid] = results
+            else:
+                outs[valid] = results
+
+    return outs, aggregate_batch(df, outs, document_ids, window_size, confidence_level), features
+
+
+class Checkpoint:
+    """
+    keeps track of the number of documents that have been indexed and of the size of every output
+    file at that point, so that partially written output can be cut off when resuming
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, CHECKPOINT_FILE)
+        self.documents_done = 0
+        self.file_sizes = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            self.documents_done = state["documents_done"]
+            self.file_sizes = state["file_sizes"]
+
+    def save(self, documents_done, files):
+        self.documents_done = documents_done
+        self.file_sizes = {
+            os.path.relpath(f.name, self.output_dir).replace(os.sep, "/"): os.fstat(f.fileno()).st_size for f in files
+        }
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"documents_done": self.documents_done, "file_sizes": self.file_sizes}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    def sizes_in(self, directory):
+        """
+        the file sizes of the files in a subdirectory of the output directory, by file name
+        """
+        prefix = directory + "/"
+        return {name[len(prefix):]: size for name, size in self.file_sizes.items() if name.startswith(prefix)}
+
+
+def open_output(output_dir, name, columns, checkpoint):
+    """
+    opens an output file for appending, cutting off anything written after the last checkpoint
+    """
+    path = os.path.join(output_dir, name)
+    size = checkpoint.file_sizes.get(name, 0)
+    f = open(path, "a+", newline="", encoding="utf-8")
+    f.truncate(size)
+    f.seek(size)
+    if size == 0:
+        csv.writer(f, delimiter=";").writerow(columns)
+    return f
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the SDGs of a corpus of documents")
+    parser.add_argument("inputs", nargs="*", help="text files, .jsonl files (optionally gzipped) or directories")
+    parser.add_argument("--from-tokens", help="score the chunks of a token shard (see tokenize_corpus.py) instead of inputs")
+    parser.add_argument("--output", required=True, help="output directory")
+    parser.add_argument("--model", default="../models/model_2.bin")
+    parser.add_argument("--model-config", default=config.BERT_CONFIG_PATH)
+    parser.add_argument("--vocab", default=config.VOCAB_PATH)
+    parser.add_argument("--precision", default=config.PRECISION, choices=["fp32", "int8"])
+    parser.add_argument("--id-field", default="id", help="document id field in .jsonl files")
+    parser.add_argument("--text-field", default="text", help="document text field in .jsonl files")
+    parser.add_argument("--batch-documents", type=int, default=64, help="documents per batch (and per checkpoint)")
+    parser.add_argument("--max-tokens", type=int, default=0,
+                        help="split documents into chunks of at most this many tokens (at most %i) "
+                             "instead of 400 words" % config.MAX_LEN)
+    parser.add_argument("--overlap", type=int, default=0, help="tokens shared by consecutive chunks with --max-tokens")
+    parser.add_argument("--window-size", type=int, default=5)
+    parser.add_argument("--confidence-level", type=float, default=0.5)
+    parser.add_argument("--num-workers", type=int, default=0, help="DataLoader workers per batch")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="chunks per forward pass (default: from the autotune file, else %i)" % config.VALID_BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch threads without --inference-processes (default: from the autotune file)")
+    parser.add_argument("--autotune-file", default="autotune.json",
+                        help="batch sizes and threads tuned for this machine by sdg-webservice/autotune.py")
+    parser.add_argument("--inference-processes", type=int, default=0,
+                        help="run the model in this many processes that share its weights, each on its own cores (CPU only)")
+    parser.add_argument("--threads-per-process", type=int, default=None,
+                        help="torch threads per inference process (default: its number of cores)")
+    parser.add_argument("--score-cache-size", type=int, default=100000,
+                        help="number of distinct chunks whose scores are kept for later batches, so chunks "
+                             "repeated across batches (boilerplate) are scored once (0: only within a batch)")
+    parser.add_argument("--chunk-processes", type=int, default=0,
+                        help="processes that clean and chunk the documents (not used with --max-tokens)")
+    parser.add_argument("--write-chunks", action="store_true",
+                        help="also store the scores of every chunk (see score_store.py) in %s/" % CHUNK_SCORES_DIR)
+    parser.add_argument("--chunk-score-dtype", default="float32", choices=["float32", "float16"])
+    parser.add_argument("--write-features", action="store_true",
+                        help="also store the CLS features of every chunk in %s/, to score them with other "
+                             "classification heads later (see rescore_features.py)" % FEATURES_DIR)
+    parser.add_argument("--feature-dtype", default="float16", choices=["float32", "float16"])
+    parser.add_argument("--profile-batches", type=int, default=0,
+                        help="write torch operator profiles and Python stack samples of the first batches to "
+                             "--profile-dir (not with --inference-processes)")
+    parser.add_argument("--profile-dir", default="profiles")
+    parser.add_argument("--slow-batch-ms", type=float, default=0,
+                        help="log the size and timings of batches that take at least this long")
+    args = parser.parse_args()
+    if args.max_tokens > config.MAX_LEN:
+        parser.error("--max-tokens can be at most %i" % config.MAX_LEN)
+    if bool(args.inputs) == bool(args.from_tokens):
+        parser.error("give either inputs or --from-tokens")
+
+    shard = None
+    if args.from_tokens:
+        shard = TokenShard(args.from_tokens)
+        if shard.max_len > config.MAX_LEN:
+            parser.error("the token shard holds chunks of up to %i tokens, the model takes %i" % (shard.max_len, config.MAX_LEN))
+        print("scoring %i chunks of %i documents from %s" % (len(shard), len(shard.document_ids), args.from_tokens))
+
+    config.NUM_WORKERS = args.num_workers
+    config.SLOW_BATCH_MS = args.slow_batch_ms
+    if args.profile_batches:
+        config.PROFILER = Profiler(args.profile_dir)
+        config.PROFILER.arm(args.profile_batches)
+    os.makedirs(args.output, exist_ok=True)
+
+    tokenizer = tokenizers.BertWordPieceTokenizer(args.vocab, lowercase=True)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    tuned = load_tuned(args.autotune_file, device.type, args.precision) or {}
+    config.VALID_BATCH_SIZE = args.batch_size or tuned.get("batch_size", config.VALID_BATCH_SIZE)
+    if not args.batch_size:
+        config.BATCH_SIZES = {int(length): size for length, size in tuned.get("batch_sizes", {}).items()}
+    threads = args.threads or tuned.get("torch_threads")
+    if threads and not args.inference_processes:
+        torch.set_num_threads(threads)
+    print("batch size %i%s, %i torch threads%s" % (
+        config.VALID_BATCH_SIZE, " (per length %s)" % config.BATCH_SIZES if config.BATCH_SIZES else "",
+        torch.get_num_threads(), " (tuned)" if tuned else ""))
+    # the features need the model itself, not a TorchScript export of its forward pass
+    model = load_model(
+        args.model, device, config_path=args.model_config, precision=args.precision,
+        torchscript_path="" if args.write_features else None
+    )
+    if args.inference_processes and device.type == 'cpu':
+        model = ParallelPredictor(model, args.inference_processes, threads_per_worker=args.threads_per_process)
+
+    checkpoint = Checkpoint(args.output)
+    if checkpoint.documents_done:
+        print("resuming after %i documents" % checkpoint.documents_done)
+
+    outputs = [open_output(args.output, DOCUMENTS_FILE, DOCUMENT_COLUMNS, checkpoint)]
+    if args.write_chunks:
+        store = ScoreStore(
+            os.path.join(args.output, CHUNK_SCORES_DIR), args.chunk_score_dtype,
+            file_sizes=checkpoint.sizes_in(CHUNK_SCORES_DIR)
+        )
+        outputs.extend(store.files)
+    if args.write_features:
+        feature_store = FeatureStore(
+            os.path.join(args.output, FEATURES_DIR), args.feature_dtype,
+            file_sizes=checkpoint.sizes_in(FEATURES_DIR), num_columns=2 * model.nb_features
+        )
+        outputs.extend(feature_store.files)
+
+    pool = multiprocessing.Pool(args.chunk_processes) if args.chunk_processes and not args.max_tokens else None
+    # the cache holds no features, so with --write-features every batch runs all its chunks
+    score_cache = ScoreCache(args.score_cache_size) if args.score_cache_size and not args.write_features else None
+
+    if args.from_tokens:
+        batches = shard_batches(shard, args.batch_documents, checkpoint.documents_done)
+    else:
+        batches = text_batches(
+            args.inputs, args.id_field, args.text_field, args.batch_documents, checkpoint.documents_done,
+            tokenizer, max_tokens=args.max_tokens, overlap=args.overlap, pool=pool
+        )
+
+    documents_done = checkpoint.documents_done
+    progress = tqdm(unit="documents", initial=documents_done)
+    for document_ids, df, input_ids in batches:
+        outs, df_agg, features = score_chunks(
+            df, document_ids, model, tokenizer, device, args.window_size, args.confidence_level, input_ids=input_ids,
+            return_features=args.write_features, score_cache=score_cache
+        )
+        df_agg.to_csv(outputs[0], sep=";", header=False, index=False)
+        if args.write_chunks:
+            store.append(document_ids, df.document, df.chunk_order, df.error, outs)
+        if args.write_features:
+            feature_store.append(document_ids, df.document, df.chunk_order, df.error, features)
+        for f in outputs:
+            f.flush()
+            os.fsync(f.fileno())
+        documents_done += len(document_ids)
+        checkpoint.save(documents_done, outputs)
+        progress.update(len(document_ids))
+
+    for f in outputs:
+        f.close()
+    if pool is not None:
+        pool.close()
+    if isinstance(model, ParallelPredictor):
+        model.close()
+    progress.close()
+    if score_cache is not None and score_cache.hits + score_cache.misses:
+        print("%i of %i distinct chunks per batch (%.1f%%) were scored in an earlier batch" % (
+            score_cache.hits, score_cache.hits + score_cache.misses,
+            100.0 * score_cache.hits / (score_cache.hits + score_cache.misses)))
+    print("indexed %i documents into %s" % (documents_done, args.output))
+
+
+if __name__ == "__main__":
+    main()
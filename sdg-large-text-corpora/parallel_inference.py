@@ -0,0 +1,179 @@
+"""
+Multi-process CPU inference for the corpus scripts
+
+A ParallelPredictor starts a number of worker processes that each run the model on their own set
+of CPU cores. The weights of a (fp32) SDGModel are moved to shared memory first, so all workers
+use the same copy. Pass the predictor to process_list_of_text in place of the model:
+
+    predictor = ParallelPredictor(model, num_workers=8)
+    outs = process_list_of_text(texts, predictor, tokenizer, device)
+    predictor.close()
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Bijan Ranjbar (MyDataExpert)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import io
+import os
+import queue
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+def available_cores():
+    """
+    the CPU cores this process may run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores, num_workers):
+    """
+    divides a list of cores into num_workers contiguous, (nearly) equally sized groups
+    """
+    size, extra = divmod(len(cores), num_workers)
+    groups = []
+    start = 0
+    for i in range(num_workers):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def _worker(model, tasks, results, cores, num_threads):
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+
+    # TorchScript models cannot be pickled, they are sent as their serialized bytes
+    if isinstance(model, bytes):
+        model = torch.jit.load(io.BytesIO(model), map_location="cpu")
+    model.eval()
+
+    with torch.no_grad():
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            index, batch, with_features = task
+            try:
+                inputs = [torch.from_numpy(batch[key]) for key in ("ids", "mask", "token_type_ids")]
+                features = None
+                if with_features:
+                    features = model.cls_features(*inputs)
+                    preds = model.head(features)
+                    features = features.numpy()
+                else:
+                    preds = model(*inputs)
+                results.put((index, (np.round(torch.sigmoid(preds).numpy(), 4), features), None))
+            except Exception:
+                results.put((index, None, traceback.format_exc()))
+
+
+class ParallelPredictor:
+    """
+    runs batches through the model in num_workers processes, each pinned to its own group of the
+    available cores and using as many torch threads as it has cores (or threads_per_worker)
+    the weights of float models are shared; quantized and TorchScript models are copied into
+    every worker
+    """
+    def __init__(self, model, num_workers, threads_per_worker=None, cores=None):
+        cores = available_cores() if cores is None else list(cores)
+        self.nb_features = getattr(model, "nb_features", None)
+        num_workers = max(1, min(num_workers, len(cores)))
+        core_groups = split_cores(cores, num_workers)
+
+        if isinstance(model, torch.jit.ScriptModule):
+            buffer = io.BytesIO()
+            torch.jit.save(model, buffer)
+            shared_model = buffer.getvalue()
+        else:
+            shared_model = model.cpu().share_memory()
+
+        context = mp.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        # at most this many batches are handed out at a time, to bound the memory in use
+        self.max_in_flight = 2 * num_workers
+        self.workers = [
+            context.Process(
+                target=_worker,
+                args=(shared_model, self.tasks, self.results, group, threads_per_worker or len(group)),
+                daemon=True
+            )
+            for group in core_groups
+        ]
+        for worker in self.workers:
+            worker.start()
+        print("started %i inference workers on cores %s" % (
+            num_workers, ", ".join("%i-%i" % (group[0], group[-1]) for group in core_groups)))
+
+    def _result(self):
+        while True:
+            try:
+                index, outs, error = self.results.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("an inference worker stopped unexpectedly")
+                continue
+            if error is not None:
+                raise RuntimeError("inference failed in a worker:\n" + error)
+            return index, outs
+
+    def predict_batches(self, batches, features=False):
+        """
+        runs the batches (dicts with ids, mask and token_type_ids tensors, as yielded by the
+        DataLoader in process_list_of_text) and returns the sigmoid outputs per batch, in order
+        with features the CLS features of every batch are returned as well, as (outputs, features)
+        """
+        outs = {}
+        in_flight = 0
+        for index, batch in enumerate(batches):
+            if in_flight >= self.max_in_flight:
+                done, batch_outs = self._result()
+                outs[done] = batch_outs
+                in_flight -= 1
+            self.tasks.put((index, {key: batch[key].numpy() for key in ("ids", "mask", "token_type_ids")}, features))
+            in_flight += 1
+
+        while in_flight:
+            done, batch_outs = self._result()
+            outs[done] = batch_outs
+            in_flight -= 1
+
+        outs = [outs[index] for index in range(len(outs))]
+        if features:
+            return [batch_outs for batch_outs, _ in outs], [batch_features for _, batch_features in outs]
+        return [batch_outs for batch_outs, _ in outs]
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,132 @@
+"""
+Command line tool that scores stored CLS features with a classification head
+
+The CLS features of a corpus are stored by `index_corpus.py --write-features` (see score_store.py)
+or by the webservice (with FEATURE_STORE_PATH set). Scoring them with a new or recalibrated head
+only runs the head (two linear layers) over the features, so it takes minutes instead of the days
+a full BERT run over the corpus takes. The head is read from a fine-tuned SDGModel checkpoint, or
+from a state dict that holds only its pooler and logit weights.
+
+For a corpus feature store the chunk scores are aggregated per document, with the same output as
+index_corpus.py (documents.csv). For a webservice feature store the scores of every stored text
+are written to scores.csv, one row per text hash.
+
+Usage:
+    python rescore_features.py --head new_head.bin --output rescored/ results/features/
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Bijan Ranjbar (MyDataExpert)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import argparse
+import csv
+import json
+import os
+
+from tqdm.autonotebook import tqdm
+from sdg_util import *
+from index_corpus import DOCUMENTS_FILE, DOCUMENT_COLUMNS, aggregate_batch, chunk_frame
+from score_store import load_features, FEATURES_FILE, META_FILE
+import numpy as np
+import torch
+
+
+# written by the webservice instead of chunks.bin and document_ids.txt: the text hash of every row
+KEYS_FILE = "keys.txt"
+SCORES_CSV = "scores.csv"
+
+
+def score_features(head, features, device, batch_size=4096):
+    """
+    runs the head over a (memory-mapped) feature matrix in batches and returns the SDG
+    probabilities (rows x 17), rounded like process_list_of_text
+    """
+    outs = np.zeros((len(features), head.logit.out_features), dtype=np.float32)
+    with torch.no_grad():
+        for start in range(0, len(features), batch_size):
+            batch = torch.from_numpy(np.asarray(features[start:start + batch_size], dtype=np.float32)).to(device)
+            outs[start:start + batch_size] = np.round(torch.sigmoid(head(batch)).cpu().numpy(), 4)
+    return outs
+
+
+def load_keyed_features(path):
+    """
+    opens a webservice feature store: returns the features and the text hash of every row
+    """
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    with open(os.path.join(path, KEYS_FILE)) as f:
+        keys = f.read().split()
+    dtype = np.dtype(meta["score_dtype"]).newbyteorder("<")
+    if not keys:
+        return np.zeros((0, meta["num_columns"]), dtype=dtype), keys
+    features = np.memmap(os.path.join(path, FEATURES_FILE), dtype=dtype, mode="r", shape=(len(keys), meta["num_columns"]))
+    return features, keys
+
+
+def check_head(head, features):
+    if features.shape[1] != 2 * head.nb_features:
+        raise ValueError("the head takes %i features, the store holds %i" % (2 * head.nb_features, features.shape[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score stored CLS features with a classification head")
+    parser.add_argument("store", help="feature store directory")
+    parser.add_argument("--output", required=True, help="output directory")
+    parser.add_argument("--head", default="../models/model_2.bin",
+                        help="SDGModel checkpoint or state dict with the pooler and logit weights")
+    parser.add_argument("--window-size", type=int, default=5)
+    parser.add_argument("--confidence-level", type=float, default=0.5)
+    parser.add_argument("--batch-documents", type=int, default=10000, help="documents per batch")
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    head = load_head(args.head, device)
+    os.makedirs(args.output, exist_ok=True)
+
+    if os.path.exists(os.path.join(args.store, KEYS_FILE)):
+        features, keys = load_keyed_features(args.store)
+        check_head(head, features)
+        outs = score_features(head, features, device)
+        with open(os.path.join(args.output, SCORES_CSV), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(["key"] + SDG_COLS)
+            writer.writerows([key] + list(row) for key, row in zip(keys, outs))
+        print("scored %i texts into %s" % (len(keys), args.output))
+        return
+
+    features, chunks, document_ids = load_features(args.store)
+    check_head(head, features)
+    offsets = np.searchsorted(chunks["document"], np.arange(len(document_ids) + 1), side="left")
+
+    with open(os.path.join(args.output, DOCUMENTS_FILE), "w", newline="", encoding="utf-8") as f:
+        csv.writer(f, delimiter=";").writerow(DOCUMENT_COLUMNS)
+        for start in tqdm(range(0, len(document_ids), args.batch_documents), unit="batches"):
+            stop = min(start + args.batch_documents, len(document_ids))
+            first_chunk, last_chunk = offsets[start], offsets[stop]
+            df = chunk_frame(chunks[first_chunk:last_chunk], document_ids[start:stop], start)
+            outs = score_features(head, features[first_chunk:last_chunk], device)
+            # like index_corpus.py, the ERROR_TEXT placeholders of unreadable documents score zero
+            outs[df.error.values] = 0
+            df_agg = aggregate_batch(df, outs, document_ids[start:stop], args.window_size, args.confidence_level)
+            df_agg.to_csv(f, sep=";", header=False, index=False)
+
+    print("rescored %i documents into %s" % (len(document_ids), args.output))
+
+
+if __name__ == "__main__":
+    main()
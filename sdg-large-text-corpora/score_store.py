@@ -0,0 +1,167 @@
+"""
+Columnar storage of the chunk scores of a corpus
+
+A score store is a directory with:
+* scores.bin: the SDG scores as one contiguous float32 or float16 matrix (17 columns, one row per chunk)
+* chunks.bin: the chunk index, one (document, chunk_order, error) record per chunk, where document
+  is the number of the document in the corpus
+* document_ids.txt: the id of every document (JSON encoded), one per line
+* store.json: the data type and number of columns of the scores
+
+A feature store (written with --write-features, see FeatureStore) has the same layout, with the CLS
+features of every chunk (1536 columns for bert-base) in features.bin instead of the scores, so other
+classification heads can score the corpus without running BERT again (see rescore_features.py).
+
+The binary files are only ever appended to and are opened as memory-mapped arrays, so the scores of
+a large corpus can be analysed (or aggregated again with other settings, see aggregate_documents
+in sdg_util.py) without loading them into pandas.
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Bijan Ranjbar (MyDataExpert)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+SCORES_FILE = "scores.bin"
+FEATURES_FILE = "features.bin"
+CHUNKS_FILE = "chunks.bin"
+DOCUMENT_IDS_FILE = "document_ids.txt"
+META_FILE = "store.json"
+
+CHUNK_DTYPE = np.dtype([("document", "<i8"), ("chunk_order", "<i4"), ("error", "?")])
+SCORE_DTYPES = ("float32", "float16")
+
+
+class ScoreStore:
+    """
+    appends the chunk scores of batches of documents to a score store directory
+    when file_sizes is given (e.g. by a checkpoint), anything written after that point is cut off
+    """
+    scores_name = SCORES_FILE
+
+    def __init__(self, path, score_dtype="float32", file_sizes=None, num_columns=17):
+        if score_dtype not in SCORE_DTYPES:
+            raise ValueError("score_dtype should be one of %s" % ", ".join(SCORE_DTYPES))
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.score_dtype = np.dtype(score_dtype).newbyteorder("<")
+        self.num_columns = num_columns
+
+        meta = {"score_dtype": score_dtype, "num_columns": num_columns}
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            stored = _read_meta(path)
+            if stored != meta:
+                raise ValueError("%s holds %s x %i values, not %s x %i" % (
+                    path, stored["score_dtype"], stored["num_columns"], score_dtype, num_columns))
+        else:
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+
+        self.files = []
+        for name in (self.scores_name, CHUNKS_FILE, DOCUMENT_IDS_FILE):
+            f = open(os.path.join(path, name), "a+b")
+            if file_sizes is not None:
+                f.truncate(file_sizes.get(name, 0))
+            f.seek(0, os.SEEK_END)
+            self.files.append(f)
+        self.scores_file, self.chunks_file, self.document_ids_file = self.files
+
+        with open(os.path.join(path, DOCUMENT_IDS_FILE), "rb") as f:
+            self.num_documents = sum(1 for _ in f)
+
+    def append(self, document_ids, chunk_documents, chunk_order, error, scores):
+        """
+        appends a batch of documents and their chunks
+        chunk_documents holds, for every chunk, the number of its document within document_ids
+        """
+        if len(scores) and np.shape(scores)[1] != self.num_columns:
+            raise ValueError("expected %i columns, got %i" % (self.num_columns, np.shape(scores)[1]))
+        chunks = np.empty(len(scores), dtype=CHUNK_DTYPE)
+        chunks["document"] = np.asarray(chunk_documents) + self.num_documents
+        chunks["chunk_order"] = chunk_order
+        chunks["error"] = error
+
+        self.scores_file.write(np.ascontiguousarray(scores, dtype=self.score_dtype).tobytes())
+        self.chunks_file.write(chunks.tobytes())
+        self.document_ids_file.write("".join(json.dumps(i) + "\n" for i in document_ids).encode("utf-8"))
+        self.num_documents += len(document_ids)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+class FeatureStore(ScoreStore):
+    """
+    appends the CLS features of the chunks of batches of documents to a feature store directory
+    """
+    scores_name = FEATURES_FILE
+
+    def __init__(self, path, feature_dtype="float16", file_sizes=None, num_columns=1536):
+        super(FeatureStore, self).__init__(path, feature_dtype, file_sizes=file_sizes, num_columns=num_columns)
+
+
+def _read_meta(path):
+    with open(os.path.join(path, META_FILE)) as f:
+        return json.load(f)
+
+
+def load_scores(path):
+    """
+    opens a score store as memory-mapped arrays
+    returns the scores (chunks x 17), the chunk index (a structured array with the fields document,
+    chunk_order and error) and the list of document ids
+    """
+    return _load_store(path, SCORES_FILE)
+
+
+def load_features(path):
+    """
+    opens a feature store as memory-mapped arrays, like load_scores
+    returns the features (chunks x 1536 for bert-base), the chunk index and the list of document ids
+    """
+    return _load_store(path, FEATURES_FILE)
+
+
+def _load_store(path, scores_name):
+    meta = _read_meta(path)
+    score_dtype = np.dtype(meta["score_dtype"]).newbyteorder("<")
+
+    def open_array(name, dtype, row_shape=()):
+        file_path = os.path.join(path, name)
+        row_size = dtype.itemsize * int(np.prod(row_shape))
+        num_rows = os.path.getsize(file_path) // row_size
+        if num_rows == 0:
+            return np.zeros((0,) + row_shape, dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode="r", shape=(num_rows,) + row_shape)
+
+    scores = open_array(scores_name, score_dtype, (meta["num_columns"],))
+    chunks = open_array(CHUNKS_FILE, CHUNK_DTYPE)
+    with open(os.path.join(path, DOCUMENT_IDS_FILE), encoding="utf-8") as f:
+        document_ids = [json.loads(line) for line in f]
+
+    return scores, chunks, document_ids
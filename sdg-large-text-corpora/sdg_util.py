@@ -27,16 +27,31 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 # !pip install tokenizers==0.0.2
 # !pip install transformers==2.8.0
 
-import re
 import os
+import string
+import hashlib
+import sys
+import json
+import time
+import inspect
+import zipfile
+import contextlib
+import collections
 import pandas as pd
 import numpy as np
-from transformers import BertPreTrainedModel, BertModel, BertConfig, get_linear_schedule_with_warmup
+from transformers import BertPreTrainedModel, BertModel, BertConfig
 import tokenizers
 import torch.nn as nn
 import torch
 from tqdm.autonotebook import tqdm
 
+# the modules shared with the webservice (profiling.py, tuning.py, benchmark_support.py) live in
+# ../sdg-webservice, whose docker image is built from that directory alone; appended, so the
+# modules of this directory come first
+WEBSERVICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "sdg-webservice")
+if WEBSERVICE_DIR not in sys.path:
+    sys.path.append(WEBSERVICE_DIR)
+
 
 # VARIABLES
 
@@ -66,6 +81,40 @@ SDG_GOALS = [
 
 SDG_COLS = ['sdg_%i'% (c+1) for c in range(17)]
 
+# chunk text that process_text uses for documents without any text
+ERROR_TEXT = "ERROR IN READING FILE"
+
+# short texts touching on different SDGs, used to compare a quantized model with the original
+PROBE_TEXTS = [
+    "Globally, the number of people living in extreme poverty declined from 36 per cent in 1990 to 10 per cent in 2015.",
+    "Education enables upward socioeconomic mobility and is a key to escaping poverty. Over the past decade, major progress was made towards increasing access to education and school enrollment rates at all levels, particularly for girls.",
+    "Stunting among children under five is associated with food insecurity, low agricultural productivity and poor access to nutritious diets.",
+    "We estimate the effect of malaria prevention programmes on child mortality and maternal health in sub-Saharan Africa.",
+    "Access to safely managed drinking water and sanitation services remains limited in rural areas.",
+    "Rooftop solar panels and wind power reduce greenhouse gas emissions and improve access to affordable clean energy.",
+    "Bottom trawling destroys deep sea coral forests and causes large bycatch of non target species in the ocean.",
+    "Deforestation and land degradation threaten biodiversity and the livelihoods of forest communities.",
+    "Anti-corruption institutions and independent courts strengthen the rule of law and access to justice.",
+    "The gender pay gap persists, and women remain underrepresented in managerial positions and parliaments.",
+]
+
+
+# characters that are kept when cleaning texts (together with newlines), all others become a space
+CHUNK_CHARACTERS = set(string.ascii_letters + string.digits + ".&!,()+'")
+
+
+# translate table that maps every byte outside CHUNK_CHARACTERS (except newlines) to a space
+_CLEAN_TABLE = bytes(i if chr(i) in CHUNK_CHARACTERS or i == 10 else 32 for i in range(128)) + bytes(128)
+
+
+def clean_lines(text):
+    """
+    splits a text string into lines in which every character outside CHUNK_CHARACTERS is
+    replaced by a space (one space per character, so the lines keep their length)
+    """
+    # encoding replaces every non-ASCII character by a single '?', which becomes a space as well
+    return text.encode("ascii", "replace").translate(_CLEAN_TABLE).decode("ascii").split("\n")
+
 
 def split_to_chunks(text, max_words=400, min_letters=5):
     """
@@ -73,38 +122,107 @@ def split_to_chunks(text, max_words=400, min_letters=5):
     symbols are removed and also very short lines (less than min_letters) are excluded.
 
     """
-    flag_new_line = True
     text_list = []
-    this_text = ""
+    this_text = []
     this_text_length = 0
-    for i, t in enumerate(text.split("\n")):
+    for t_clean in clean_lines(text):
 
-        if len(t) > min_letters:
-            t_clean = re.sub('[^0-9a-zA-Z.&!,()+\']', ' ', t)
-            t_clean = t_clean.replace("...","").replace(" . . ","")
-            this_text_length = this_text_length + len(t_clean.split(" "))
+        if len(t_clean) > min_letters:
+            if "." in t_clean:
+                t_clean = t_clean.replace("...","").replace(" . . ","")
+            this_text_length = this_text_length + t_clean.count(" ") + 1
             if this_text_length <= max_words:
-                this_text += t_clean + " "
+                this_text.append(t_clean)
             else:
-                text_list.append(this_text.strip()) 
-                this_text = t_clean + " "
+                text_list.append(" ".join(this_text).strip())
+                this_text = [t_clean]
                 this_text_length = 0
 
-    if len(this_text) > 1:
-        text_list.append(this_text.strip()) 
-    
+    if this_text:
+        text_list.append(" ".join(this_text).strip())
+
     return [t for t in text_list if t]
 
 
+def split_texts_to_chunks(texts, pool=None, chunksize=16):
+    """
+    runs split_to_chunks on a list of text strings, in a multiprocessing pool when one is given
+    returns the chunks of every text in input order
+    """
+    if pool is None:
+        return [split_to_chunks(text) for text in texts]
+    return pool.map(split_to_chunks, texts, chunksize=chunksize)
+
+
+def split_to_token_chunks(text, tokenizer, max_tokens=None, overlap=0, min_letters=5):
+    """
+    splits a text string into chunks of at most max_tokens WordPiece tokens (including [CLS] and
+    [SEP], config.MAX_LEN by default), so that no text is lost to truncation by the model.
+    lines are cleaned like in split_to_chunks; chunks end at a word boundary and consecutive
+    chunks share `overlap` tokens (rounded up to a word boundary).
+    returns the chunk texts and the token ids of every chunk, ready for process_list_of_text
+
+    """
+    max_tokens = max_tokens or config.MAX_LEN
+    budget = max_tokens - 2
+    if not 0 <= overlap < budget:
+        raise ValueError("overlap should be at least 0 and less than max_tokens - 2")
+
+    lines = [t.replace("...","").replace(" . . ","") for t in clean_lines(text) if len(t) > min_letters]
+    clean_text = " ".join(lines).strip()
+    if not clean_text:
+        return [], []
+
+    # the cleaned text is plain ASCII, which the tokenizer's normalizer (lowercasing) leaves at
+    # the same length, so the offsets point into clean_text
+    encoding = tokenizer.encode(clean_text)
+    cls_id, sep_id = encoding.ids[0], encoding.ids[-1]
+    ids, tokens, offsets = encoding.ids[1:-1], encoding.tokens[1:-1], encoding.offsets[1:-1]
+
+    text_list = []
+    ids_list = []
+    start = 0
+    while start < len(ids):
+        end = min(start + budget, len(ids))
+        if end < len(ids):
+            # do not cut a word in two, unless the word alone is longer than the budget
+            cut = end
+            while cut > start and tokens[cut].startswith("##"):
+                cut -= 1
+            if cut > start:
+                end = cut
+
+        text_list.append(clean_text[offsets[start][0]:offsets[end - 1][1]])
+        ids_list.append([cls_id] + ids[start:end] + [sep_id])
+        if end == len(ids):
+            break
+
+        next_start = end - overlap
+        while next_start > start and tokens[next_start].startswith("##"):
+            next_start -= 1
+        start = next_start if next_start > start else end
+
+    return text_list, ids_list
+
+
 # FUNCTION
-def process_text(text):
+def process_text(text, tokenizer=None, max_tokens=None, overlap=0, text_list=None):
     """
     turning a text string into a dataframe by adding the chunk order and error status
+    with a tokenizer the text is split into chunks of at most max_tokens tokens (see
+    split_to_token_chunks) and their token ids are kept in the input_ids column
+    text_list can hold the result of split_to_chunks(text) when it was already computed (e.g. by
+    split_texts_to_chunks)
     """
-    text_list = split_to_chunks(text)
+    if tokenizer is not None:
+        text_list, ids_list = split_to_token_chunks(text, tokenizer, max_tokens=max_tokens, overlap=overlap)
+    else:
+        text_list, ids_list = split_to_chunks(text) if text_list is None else text_list, None
     if not text_list:
-        text_list = ["ERROR IN READING FILE"]
+        text_list = [ERROR_TEXT]
         error = True
+        if tokenizer is not None:
+            ids_list = [tokenizer.encode(text_list[0]).ids]
     else:
         error = False
     df = pd.DataFrame({
@@ -112,33 +230,38 @@ def process_text(text):
             "chunk_order": list(range(len(text_list))),
             "error": [error] * len(text_list),
         })
+    if ids_list is not None:
+        df["input_ids"] = ids_list
     return df
 
 
-def process_data(text, tokenizer, max_len):
+def process_data(text, tokenizer, max_len, pad=True):
     """
     process a text string and turns it into tokens needed for the Bert model
     """
     tok_abs = tokenizer.encode(text)
     
-    input_ids_orig = tok_abs.ids
-    
-    
+    return process_ids(tok_abs.ids, max_len, pad=pad)
+
+def process_ids(input_ids_orig, max_len, pad=True):
+    """
+    turns a list of token ids into the (padded or truncated) inputs needed for the Bert model
+    """
     token_type_ids = [1] * (len(input_ids_orig))
     mask = [1] * len(token_type_ids)
                       
                      
     padding_length = max_len - len(input_ids_orig)
-    if padding_length > 0:
+    if pad and padding_length > 0:
         input_ids_orig = input_ids_orig + ([0] * padding_length)
         mask = mask + ([0] * padding_length)
         token_type_ids = token_type_ids + ([0] * padding_length)
         
                       
     if  padding_length < 0:
-        input_ids_orig = input_ids_orig[:512]
-        mask = mask[:512]
-        token_type_ids = token_type_ids[:512]
+        input_ids_orig = input_ids_orig[:max_len]
+        mask = mask[:max_len]
+        token_type_ids = token_type_ids[:max_len]
         
     return {
         'ids': input_ids_orig,
@@ -147,25 +270,186 @@ def process_data(text, tokenizer, max_len):
         
     }
 
-def process_list_of_text(text_list, model, tokenizer, device):
+def pad_batch(batch):
+    """
+    collate function that pads a batch only to the length of its longest member
+    """
+    return {
+        key: torch.nn.utils.rnn.pad_sequence([item[key] for item in batch], batch_first=True)
+        for key in ('ids', 'mask', 'token_type_ids')
+    }
+
+def restore_order(outs, order):
+    """
+    puts predictions made in the order of a LengthSortedBatchSampler back in input order
+    """
+    restored = np.empty_like(outs)
+    restored[order] = outs
+    return restored
+
+def profile_batch():
+    """
+    the context a batch runs in: profiles it when config.PROFILER (see profiling.py in
+    ../sdg-webservice) is set and armed, otherwise does nothing
+    """
+    if config.PROFILER is None:
+        return contextlib.suppress()
+    return config.PROFILER.profile("batch")
+
+
+def log_slow_batch(bi, mask, load_seconds, run_seconds):
+    """
+    prints the size and timings of a batch that took at least config.SLOW_BATCH_MS
+    """
+    if not config.SLOW_BATCH_MS or (load_seconds + run_seconds) * 1000 < config.SLOW_BATCH_MS:
+        return
+    tqdm.write("slow batch %i: %i texts, %i tokens (%i with padding), loading %.1f ms, model %.1f ms" % (
+        bi, mask.shape[0], int(mask.sum()), mask.numel(), load_seconds * 1000, run_seconds * 1000))
+
+
+class ScoreCache:
+    """
+    the sdg scores of at most max_entries distinct texts (or sequences of token ids), keyed by
+    their sha1 hash, so process_list_of_text can reuse them across calls; the least recently used
+    entries are dropped first
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.scores = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode("utf-8") if isinstance(text, str) else text).digest()
+
+    def get_many(self, texts):
+        """
+        the scores of every text, or None for texts that are not cached
+        """
+        rows = []
+        for text in texts:
+            key = self.key(text)
+            row = self.scores.get(key)
+            if row is not None:
+                self.scores.move_to_end(key)
+            rows.append(row)
+        found = sum(row is not None for row in rows)
+        self.hits += found
+        self.misses += len(rows) - found
+        return rows
+
+    def put_many(self, texts, scores):
+        for text, row in zip(texts, scores):
+            self.scores[self.key(text)] = np.array(row, dtype=np.float32)
+        while len(self.scores) > self.max_entries:
+            self.scores.popitem(last=False)
+
+
+def process_list_of_text(text_list, model, tokenizer, device, dynamic_padding=True, as_matrix=False, input_ids=None,
+                         deduplicate=False, return_features=False, score_cache=None):
     """
     processes a list of text and for each one predicts the SDGs
+    with dynamic_padding the texts are batched by token length and every batch is only padded
+    to its longest text; the predictions are returned in the original order
+    with as_matrix the predictions are returned as one float32 matrix (texts x 17) instead of a
+    list of rows
+    input_ids can hold the token ids of the texts (e.g. from process_text with a tokenizer, or the
+    TokenIds of a token shard, see token_shards.py), so they are not tokenized again; text_list
+    may then be None
+    with deduplicate every distinct text (or sequence of token ids, without texts) is only run
+    through the model once (repeated chunks are common in scraped documents), and ERROR_TEXT
+    placeholders are not run at all but get zero scores; a score_cache (see ScoreCache) then
+    also answers the texts it holds from earlier calls and keeps the newly scored ones, it holds
+    no features so it cannot be combined with return_features
+    with return_features the CLS features the head scores (see SDGModel.cls_features, texts x
+    1536 for bert-base) are returned as well, as (predictions, features); this needs an SDGModel (or a
+    ParallelPredictor of one), not a TorchScript export
+    batches run in this process can be profiled (config.PROFILER) and are logged when they are
+    slow (config.SLOW_BATCH_MS)
     """
 
+    if score_cache is not None and (return_features or not deduplicate):
+        raise ValueError("a score cache needs deduplicate and holds no features")
+
+    if deduplicate:
+        if text_list is not None:
+            keys = list(text_list)
+        else:
+            keys = [np.asarray(ids, dtype=np.int32).tobytes() for ids in input_ids]
+        codes, unique_keys = pd.factorize(pd.Series(keys, dtype=object))
+        first_index = np.unique(codes, return_index=True)[1]
+        if text_list is not None:
+            predict = np.flatnonzero(unique_keys != ERROR_TEXT)
+        else:
+            predict = np.arange(len(unique_keys))
+
+        unique_outs = np.zeros((len(unique_keys), 17), dtype=np.float32)
+        unique_features = np.zeros((len(unique_keys), 2 * model.nb_features if return_features else 0), dtype=np.float32)
+        if score_cache is not None and len(predict):
+            cached = score_cache.get_many(unique_keys[predict])
+            found = np.array([row is not None for row in cached], dtype=bool)
+            if found.any():
+                unique_outs[predict[found]] = [row for row in cached if row is not None]
+            predict = predict[~found]
+
+        unique_ids = None
+        if input_ids is not None:
+            if hasattr(input_ids, "subset"):
+                unique_ids = input_ids.subset(first_index[predict])
+            else:
+                input_ids = list(input_ids)
+                unique_ids = [input_ids[i] for i in first_index[predict]]
+
+        if len(predict):
+            results = process_list_of_text(
+                list(unique_keys[predict]) if text_list is not None else None, model, tokenizer, device,
+                dynamic_padding=dynamic_padding, as_matrix=True, input_ids=unique_ids, return_features=return_features
+            )
+            if return_features:
+                unique_outs[predict], unique_features[predict] = results
+            else:
+                unique_outs[predict] = results
+            if score_cache is not None:
+                score_cache.put_many(unique_keys[predict], unique_outs[predict])
+        outs = unique_outs[codes]
+        outs = outs if as_matrix else list(outs)
+        return (outs, unique_features[codes]) if return_features else outs
+
     outs = []
 
     test_dataset = SDGDataset(
-        abstract=text_list, tokenizer=tokenizer)
-
-    test_data_loader = torch.utils.data.DataLoader(
-        test_dataset,
-        batch_size=config.VALID_BATCH_SIZE,
-        num_workers=config.NUM_WORKERS
-    )
+        abstract=text_list, tokenizer=tokenizer, dynamic_padding=dynamic_padding, input_ids=input_ids)
+
+    if dynamic_padding:
+        batch_sampler = LengthSortedBatchSampler(
+            test_dataset.token_lengths(), config.VALID_BATCH_SIZE, config.BATCH_SIZES)
+        test_data_loader = torch.utils.data.DataLoader(
+            test_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=pad_batch,
+            num_workers=config.NUM_WORKERS
+        )
+    else:
+        test_data_loader = torch.utils.data.DataLoader(
+            test_dataset,
+            batch_size=batch_size_for(config.MAX_LEN, config.VALID_BATCH_SIZE, config.BATCH_SIZES),
+            num_workers=config.NUM_WORKERS
+        )
     
+    features = []
     tk0 = tqdm(test_data_loader, total=len(test_data_loader))
-    with torch.no_grad():
-        for bi, d in enumerate(tk0):
+    if hasattr(model, "predict_batches"):
+        # a ParallelPredictor (see parallel_inference.py) spreads the batches over processes
+        if return_features:
+            outs, features = model.predict_batches(tk0, features=True)
+        else:
+            outs = model.predict_batches(tk0)
+    else:
+        with torch.no_grad():
+            load_start = time.perf_counter()
+            for bi, d in enumerate(tk0):
+                run_start = time.perf_counter()
 
                 ids = d["ids"]
                 token_type_ids = d["token_type_ids"]
@@ -175,18 +459,32 @@ def process_list_of_text(text_list, model, tokenizer, device):
                 token_type_ids = token_type_ids.to(device, dtype=torch.long)
                 mask = mask.to(device, dtype=torch.long)
 
-                preds = model(
-                    ids=ids,
-                    mask=mask,
-                    token_type_ids=token_type_ids,
-                )
+                with profile_batch():
+                    if return_features:
+                        cls = model.cls_features(ids, mask, token_type_ids)
+                        preds = model.head(cls)
+                        features.append(cls.cpu().numpy())
+                    else:
+                        preds = model(ids, mask, token_type_ids)
 
-                outs.append(np.round(torch.sigmoid(preds).cpu().detach().numpy(),4))
+                    outs.append(np.round(torch.sigmoid(preds).cpu().detach().numpy(),4))
+
+                log_slow_batch(bi, d["mask"], run_start - load_start, time.perf_counter() - run_start)
+                load_start = time.perf_counter()
             
             
     outs = np.vstack(outs)
-
-    outs = list(outs)
+    if dynamic_padding:
+        outs = restore_order(outs, batch_sampler.order)
+    if return_features:
+        features = np.vstack(features).astype(np.float32, copy=False)
+        if dynamic_padding:
+            features = restore_order(features, batch_sampler.order)
+
+    if not as_matrix:
+        outs = list(outs)
+    if return_features:
+        return outs, features
     return outs
 
 
@@ -245,6 +543,90 @@ def aggregated_sdg_score(df_sdg_smooth, CONFIDENCE_LEVEL=0.5):
 
     return scores, top_sdg_index, num_valid_chunks
 
+
+def document_offsets(document_keys):
+    """
+    returns the offsets of the documents in a column of document keys (e.g. ids) in which the
+    chunks of every document are contiguous: document d spans rows offsets[d] to offsets[d+1]
+    """
+    keys = np.asarray(document_keys)
+    if len(keys) == 0:
+        return np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    return np.append(starts, len(keys)).astype(np.int64)
+
+
+def aggregate_documents(sdg_scores, offsets, window_size=5, CONFIDENCE_LEVEL=0.5):
+    """
+    smoothens and aggregates the sdg scores of many documents at once, with the same results as
+    calling smoothen_sdg_values and aggregated_sdg_score for every document
+    sdg_scores:
+        matrix with one row per text chunk and 17 columns containing the sdg scores coming
+        from the Bert model, the chunks of every document contiguous and in chunk order
+    offsets:
+        the start row of every document followed by the number of rows (see document_offsets)
+
+    returns the scores (documents x 17), the index of the top sdg and the number of valid chunks
+    of every document
+    """
+    sdg_scores = np.asarray(sdg_scores, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    num_docs = len(lengths)
+
+    # like smoothen_sdg_values: the window is the document length for documents shorter than 5 chunks
+    windows = np.where(lengths < 5, lengths, window_size)
+    row_document = np.repeat(np.arange(num_docs), lengths)
+    row_window = windows[row_document]
+    row_position = np.arange(len(sdg_scores)) - offsets[:-1][row_document]
+
+    # rolling mean: the first window - 1 chunks of a document have no value (NaN)
+    has_value = row_position >= row_window - 1
+    window_start = np.arange(len(sdg_scores)) - row_window + 1
+    window_sum = np.zeros_like(sdg_scores)
+    for step in range(windows.max() if num_docs else 0):
+        rows = np.flatnonzero(has_value & (step < row_window))
+        window_sum[rows] += sdg_scores[window_start[rows] + step]
+    sdg_smooth = np.full_like(sdg_scores, np.nan)
+    sdg_smooth[has_value] = window_sum[has_value] / row_window[has_value, None]
+
+    # like aggregated_sdg_score: count the chunks per sdg and the chunks with any sdg, per document
+    binary = sdg_smooth >= CONFIDENCE_LEVEL
+    counts = np.zeros((len(sdg_scores) + 1, 18), dtype=np.int64)
+    np.cumsum(np.hstack([binary, binary.any(axis=1, keepdims=True)]), axis=0, out=counts[1:])
+    document_counts = counts[offsets[1:]] - counts[offsets[:-1]]
+    sdg_count = document_counts[:, :17].astype(np.float64)
+    num_valid_chunks = document_counts[:, 17].astype(np.float64)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = sdg_count / num_valid_chunks[:, None]
+    top_sdg_index = np.where(num_valid_chunks > 0, np.argmax(sdg_count, axis=1), 17)
+
+    return scores, top_sdg_index, num_valid_chunks
+
+
+def aggregate_chunks(df, sdg_scores, window_size=5, CONFIDENCE_LEVEL=0.5, document_column="id"):
+    """
+    turns the chunk data frame (see process_text, with an id column added) and its sdg scores
+    into a data frame with one row per document
+    the chunks of every document have to be contiguous; document_column identifies the documents
+    and is the id column of the result, whose parsing_error is taken from the error column (False
+    without one)
+    """
+    offsets = document_offsets(df[document_column].values)
+    scores, top_sdg_index, num_valid_chunks = aggregate_documents(
+        sdg_scores, offsets, window_size=window_size, CONFIDENCE_LEVEL=CONFIDENCE_LEVEL
+    )
+    df_agg = pd.DataFrame({
+        "id": df[document_column].values[offsets[:-1]],
+        "parsing_error": df.error.values[offsets[:-1]] if "error" in df else False,
+        "num_chunks": np.diff(offsets),
+        "num_valid_chunks": num_valid_chunks,
+        "document_top_sdg": [SDG_GOALS[i] for i in top_sdg_index],
+    })
+    df_agg[SDG_COLS] = pd.DataFrame(scores, index=df_agg.index)
+    return df_agg
+
 # BERT CLASSES
 class config:
     """
@@ -252,8 +634,16 @@ class config:
     """
     MAX_LEN = 512
     VALID_BATCH_SIZE = 16
+    # the batch size per sequence length (see batch_size_for), e.g. from an autotune file
+    BATCH_SIZES = {}
     NUM_WORKERS = 16
-    BERT_PATH = 'bert-base-uncased'
+    BERT_CONFIG_PATH = '../models/bert-base-uncased-config.json'
+    VOCAB_PATH = '../models/bert-base-uncased-vocab.txt'
+    PRECISION = 'fp32'
+    # a profiling.Profiler for the batches of process_list_of_text, and the time in milliseconds
+    # from which a batch is logged as slow (0: never)
+    PROFILER = None
+    SLOW_BATCH_MS = 0
 
 class SDGModel(BertPreTrainedModel):
     """
@@ -261,7 +651,7 @@ class SDGModel(BertPreTrainedModel):
     """
     def __init__(self, conf):
         super(SDGModel, self).__init__(conf)
-        self.bert = BertModel.from_pretrained(config.BERT_PATH, config=conf)
+        self.bert = BertModel(conf)
         self.drop_out = nn.Dropout(0.1)
         
         
@@ -276,15 +666,27 @@ class SDGModel(BertPreTrainedModel):
  
         torch.nn.init.normal_(self.logit.weight, std=0.02)
     
-    def forward(self, ids, mask, token_type_ids):
-        last_hidden_state ,pooler_output , hidden_states = self.bert(
-            ids,
-            attention_mask=mask,
-            token_type_ids=token_type_ids
-        )
-        out = torch.cat((hidden_states[-1][:, 0], hidden_states[-2][:, 0]), dim=-1)
-         
-        out = self.drop_out(out)
+    def cls_features(self, ids, mask, token_type_ids):
+        """
+        runs the Bert encoder layer by layer and only keeps the CLS vectors of the last two layers
+        (no full hidden states of every layer and no unused Bert pooler)
+        """
+        extended_mask = mask[:, None, None, :].to(dtype=next(self.bert.parameters()).dtype)
+        extended_mask = (1.0 - extended_mask) * -10000.0
+
+        hidden_states = self.bert.embeddings(input_ids=ids, token_type_ids=token_type_ids)
+        for layer in self.bert.encoder.layer[:-1]:
+            hidden_states = layer(hidden_states, extended_mask)[0]
+        second_to_last_cls = hidden_states[:, 0]
+        hidden_states = self.bert.encoder.layer[-1](hidden_states, extended_mask)[0]
+
+        return torch.cat((hidden_states[:, 0], second_to_last_cls), dim=-1)
+
+    def head(self, features):
+        """
+        the classification head: turns the features of cls_features into logits
+        """
+        out = self.drop_out(features)
         out = self.pooler(out)
         
         logits = self.logit(out)
@@ -292,24 +694,218 @@ class SDGModel(BertPreTrainedModel):
 
         return logits
 
+    def forward(self, ids, mask, token_type_ids):
+        return self.head(self.cls_features(ids, mask, token_type_ids))
+
+class SDGHead(nn.Module):
+    """
+    the classification head of SDGModel (pooler and logit) on its own, to score stored CLS
+    features (see rescore_features.py)
+    """
+    def __init__(self, nb_features, num_labels=17):
+        super(SDGHead, self).__init__()
+        self.nb_features = nb_features
+        self.pooler = nn.Sequential(
+            nn.Linear(nb_features * 2, nb_features),
+            nn.Tanh(),
+        )
+        self.logit = nn.Linear(nb_features, num_labels)
+
+    def forward(self, features):
+        return self.logit(self.pooler(features))
+
+def load_head(path, device):
+    """
+    loads the pooler and logit weights of a fine-tuned SDGModel checkpoint (or of a state dict
+    holding only those) into an SDGHead
+    """
+    state_dict = torch.load(path, map_location=device)
+    state_dict = state_dict.get('model_state_dict', state_dict)
+    state_dict = {key: value for key, value in state_dict.items() if key.startswith(('pooler.', 'logit.'))}
+    if 'logit.weight' not in state_dict:
+        raise ValueError("%s holds no SDG classification head" % path)
+
+    num_labels, nb_features = state_dict['logit.weight'].shape
+    head = SDGHead(nb_features, num_labels)
+    head.load_state_dict(state_dict)
+    head.eval()
+    head.to(device)
+    return head
+
+def checkpoint_identity(path):
+    """
+    the file name, size and modification time of a checkpoint, as recorded in an export by
+    sdg-webservice/export_torchscript.py (see checkpoint_identity in sdg-webservice/sdg_model.py)
+    """
+    stat = os.stat(path)
+    return {'file': os.path.basename(path), 'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+def default_torchscript_path(model_path):
+    """
+    where export_torchscript.py writes the export of a checkpoint by default
+    """
+    return os.path.splitext(model_path)[0] + ".torchscript.pt"
+
+def load_torchscript_model(path, device, precision, checkpoint_path):
+    """
+    loads a model exported with sdg-webservice/export_torchscript.py
+    returns None when it was exported for another precision or device type, or from another
+    checkpoint than the one at checkpoint_path
+    """
+    start = time.perf_counter()
+    extra_files = {'metadata': ''}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    metadata = extra_files['metadata']
+    metadata = json.loads(metadata.decode() if isinstance(metadata, bytes) else metadata)
+
+    if metadata['precision'] != precision or metadata['device'] != torch.device(device).type:
+        print("not using TorchScript model %s: exported for %s on %s" % (path, metadata['precision'], metadata['device']))
+        return None
+    if metadata.get('checkpoint') != checkpoint_identity(checkpoint_path):
+        print("not using TorchScript model %s: exported from %s, not from %s" % (path, metadata.get('checkpoint'), checkpoint_path))
+        return None
+
+    model.eval()
+    print("TorchScript model loaded in %.2fs" % (time.perf_counter() - start))
+    return model
+
+def load_model(model_path, device, config_path=None, precision=None, check_precision=True, torchscript_path=None):
+    """
+    builds the SDGModel from the bundled Bert config and loads the fine-tuned weights once,
+    so no pretrained bert-base-uncased weights are downloaded (works offline)
+    the checkpoint is memory-mapped when torch supports it (torch >= 2.1, zip format checkpoint)
+    with precision 'int8' the Linear layers are dynamically quantized (CPU only) and, when
+    check_precision is set, the deviation from the fp32 model on PROBE_TEXTS is printed
+    when an export of model_path with the same precision exists at torchscript_path (next to
+    the checkpoint by default, see default_torchscript_path) that is loaded instead; pass
+    torchscript_path='' to always build the model
+    """
+    precision = precision or config.PRECISION
+    if precision not in ('fp32', 'int8'):
+        raise ValueError("unsupported precision %s (use fp32 or int8)" % precision)
+    if precision == 'int8' and torch.device(device).type != 'cpu':
+        raise ValueError("int8 precision is only supported on the CPU")
+
+    if torchscript_path is None:
+        torchscript_path = default_torchscript_path(model_path)
+    if torchscript_path and os.path.exists(torchscript_path):
+        model = load_torchscript_model(torchscript_path, device, precision, model_path)
+        if model is not None:
+            return model
+
+    start = time.perf_counter()
+    model_config = BertConfig.from_json_file(config_path or config.BERT_CONFIG_PATH)
+    model = SDGModel(conf=model_config)
+
+    load_args = {'map_location': device}
+    if 'mmap' in inspect.signature(torch.load).parameters and zipfile.is_zipfile(model_path):
+        load_args['mmap'] = True
+    model.load_state_dict(torch.load(model_path, **load_args)['model_state_dict'])
+
+    model.eval()
+    model.to(device)
+    print("model loaded in %.2fs" % (time.perf_counter() - start))
+
+    if precision == 'int8':
+        quantized = quantize_model(model)
+        if check_precision:
+            deviation = max_score_deviation(model, quantized, device)
+            print("maximum score deviation from fp32 per SDG: " + ", ".join(
+                "sdg_%i=%.4f" % (i + 1, value) for i, value in enumerate(deviation)))
+        model = quantized
+
+    return model
+
+def quantize_model(model):
+    """
+    returns a copy of the model with all Linear layers dynamically quantized to int8 (CPU only)
+    """
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def max_score_deviation(reference, candidate, device, texts=None, tokenizer=None):
+    """
+    returns the maximum absolute difference per SDG between the scores of two models
+    on a set of probe texts (PROBE_TEXTS by default)
+    """
+    texts = texts or PROBE_TEXTS
+    tokenizer = tokenizer or tokenizers.BertWordPieceTokenizer(config.VOCAB_PATH, lowercase=True)
+    reference_scores = np.vstack(process_list_of_text(texts, reference, tokenizer, device))
+    candidate_scores = np.vstack(process_list_of_text(texts, candidate, tokenizer, device))
+    return np.abs(reference_scores - candidate_scores).max(axis=0)
+
+def batch_size_for(length, batch_size, batch_sizes=None):
+    """
+    the batch size for texts of up to `length` tokens: that of the shortest length in
+    batch_sizes (sequence lengths to batch sizes) that holds them, else batch_size
+    """
+    tuned = [size for tuned_length, size in sorted((batch_sizes or {}).items()) if length <= tuned_length]
+    return tuned[0] if tuned else batch_size
+
+class LengthSortedBatchSampler():
+    """
+    batch sampler that groups texts of similar token length, longest first
+    with batch_sizes (see batch_size_for) every batch holds as many texts as suits its longest text
+    order holds the input index of every text in the order in which they are yielded
+    """
+    def __init__(self, lengths, batch_size, batch_sizes=None):
+        self.order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+        self.batches = []
+        start = 0
+        while start < len(self.order):
+            end = start + batch_size_for(lengths[self.order[start]], batch_size, batch_sizes)
+            self.batches.append(self.order[start:end])
+            start = end
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
 class SDGDataset():
     """
     class for the SDG input
     """
-    def __init__(self, abstract, tokenizer):
+    def __init__(self, abstract, tokenizer, dynamic_padding=False, input_ids=None):
         self.abstract = abstract
         self.tokenizer = tokenizer
         self.max_len = config.MAX_LEN
+        self.dynamic_padding = dynamic_padding
+        # token ids read from a token shard stay memory-mapped
+        if input_ids is not None and not hasattr(input_ids, "lengths"):
+            input_ids = list(input_ids)
+        self.input_ids = input_ids
     
     def __len__(self):
+        if self.input_ids is not None:
+            return len(self.input_ids)
         return len(self.abstract)
 
+    def token_lengths(self):
+        """
+        tokenizes all texts in one go (reused by __getitem__) and returns their truncated lengths
+        """
+        if self.input_ids is None:
+            encodings = self.tokenizer.encode_batch(list(self.abstract))
+            self.input_ids = [encoding.ids for encoding in encodings]
+        if hasattr(self.input_ids, "lengths"):
+            return np.minimum(self.input_ids.lengths(), self.max_len).tolist()
+        return [min(len(ids), self.max_len) for ids in self.input_ids]
+
     def __getitem__(self, item):
-        data = process_data(
-            self.abstract[item], 
-            self.tokenizer,
-            self.max_len
-        )
+        if self.input_ids is not None:
+            data = process_ids(
+                self.input_ids[item],
+                self.max_len,
+                pad=not self.dynamic_padding
+            )
+        else:
+            data = process_data(
+                self.abstract[item], 
+                self.tokenizer,
+                self.max_len,
+                pad=not self.dynamic_padding
+            )
 
         return {
             'ids': torch.tensor(data["ids"], dtype=torch.long),
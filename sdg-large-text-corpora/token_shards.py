@@ -0,0 +1,187 @@
+"""
+Pre-tokenized corpus shards
+
+A token shard holds the chunks of a corpus as token ids, so a corpus can be scored again (with
+another model, window size or confidence level) without cleaning, chunking and tokenizing every
+document again. A shard is a directory with:
+* tokens.bin: the token ids of all chunks, concatenated without padding (int16 or int32)
+* token_ends.bin: the end offset of every chunk in tokens.bin (int64)
+* chunks.bin: the chunk index, one (document, chunk_order, error) record per chunk (see score_store.py)
+* document_ids.txt: the id of every document (JSON encoded), one per line
+* shard.json: the token data type and the settings the chunks were made with
+
+The token ids are read as memory-mapped arrays; TokenIds can be passed to process_list_of_text
+(and SDGDataset) as input_ids, which pads every batch only when it is built.
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Bijan Ranjbar (MyDataExpert)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import json
+import os
+
+import numpy as np
+
+from score_store import CHUNK_DTYPE
+
+
+TOKENS_FILE = "tokens.bin"
+TOKEN_ENDS_FILE = "token_ends.bin"
+CHUNKS_FILE = "chunks.bin"
+DOCUMENT_IDS_FILE = "document_ids.txt"
+META_FILE = "shard.json"
+
+TOKEN_DTYPES = ("int16", "int32")
+
+
+class TokenShardWriter:
+    """
+    appends the chunks of batches of documents to a token shard directory
+    token ids are truncated to max_len, like the model input; when file_sizes is given (e.g. by a
+    checkpoint), anything written after that point is cut off
+    """
+    def __init__(self, path, token_dtype="int16", max_len=512, settings=None, file_sizes=None):
+        if token_dtype not in TOKEN_DTYPES:
+            raise ValueError("token_dtype should be one of %s" % ", ".join(TOKEN_DTYPES))
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.token_dtype = np.dtype(token_dtype).newbyteorder("<")
+        self.max_len = max_len
+
+        meta = {"token_dtype": token_dtype, "max_len": max_len, "settings": settings or {}}
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                stored = json.load(f)
+            if stored != meta:
+                raise ValueError("%s was written with other settings: %s" % (path, stored))
+        else:
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+
+        self.files = []
+        for name in (TOKENS_FILE, TOKEN_ENDS_FILE, CHUNKS_FILE, DOCUMENT_IDS_FILE):
+            f = open(os.path.join(path, name), "a+b")
+            if file_sizes is not None:
+                f.truncate(file_sizes.get(name, 0))
+            f.seek(0, os.SEEK_END)
+            self.files.append(f)
+        self.tokens_file, self.token_ends_file, self.chunks_file, self.document_ids_file = self.files
+
+        self.num_tokens = self.tokens_file.tell() // self.token_dtype.itemsize
+        with open(os.path.join(path, DOCUMENT_IDS_FILE), "rb") as f:
+            self.num_documents = sum(1 for _ in f)
+
+    def append(self, document_ids, chunk_documents, chunk_order, error, input_ids):
+        """
+        appends a batch of documents and the token ids of their chunks
+        chunk_documents holds, for every chunk, the number of its document within document_ids
+        """
+        input_ids = [ids[:self.max_len] for ids in input_ids]
+        tokens = np.fromiter((i for ids in input_ids for i in ids), dtype=np.int64)
+        if len(tokens) and tokens.max() > np.iinfo(self.token_dtype).max:
+            raise ValueError("token id %i does not fit in %s" % (tokens.max(), self.token_dtype.name))
+        ends = self.num_tokens + np.cumsum([len(ids) for ids in input_ids], dtype=np.int64)
+
+        chunks = np.empty(len(input_ids), dtype=CHUNK_DTYPE)
+        chunks["document"] = np.asarray(chunk_documents) + self.num_documents
+        chunks["chunk_order"] = chunk_order
+        chunks["error"] = error
+
+        self.tokens_file.write(tokens.astype(self.token_dtype).tobytes())
+        self.token_ends_file.write(ends.astype("<i8").tobytes())
+        self.chunks_file.write(chunks.tobytes())
+        self.document_ids_file.write("".join(json.dumps(i) + "\n" for i in document_ids).encode("utf-8"))
+        self.num_tokens += len(tokens)
+        self.num_documents += len(document_ids)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+class TokenIds:
+    """
+    sequence of the token ids (as lists) of chunks in a memory-mapped token array
+    """
+    def __init__(self, tokens, starts, ends):
+        self.tokens = tokens
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, item):
+        return self.tokens[self.starts[item]:self.ends[item]].tolist()
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def lengths(self):
+        return self.ends - self.starts
+
+    def subset(self, indices):
+        return TokenIds(self.tokens, self.starts[indices], self.ends[indices])
+
+
+class TokenShard:
+    """
+    reads a token shard as memory-mapped arrays
+    chunks is the chunk index (fields document, chunk_order and error), document_ids the list of
+    document ids and document_offsets the first chunk of every document followed by the number of
+    chunks
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.max_len = self.meta["max_len"]
+        self.settings = self.meta["settings"]
+
+        self.tokens = self._open_array(TOKENS_FILE, np.dtype(self.meta["token_dtype"]).newbyteorder("<"))
+        self.token_ends = self._open_array(TOKEN_ENDS_FILE, np.dtype("<i8"))
+        self.chunks = self._open_array(CHUNKS_FILE, CHUNK_DTYPE)
+        with open(os.path.join(path, DOCUMENT_IDS_FILE), encoding="utf-8") as f:
+            self.document_ids = [json.loads(line) for line in f]
+
+        self.token_starts = np.concatenate([[0], self.token_ends[:-1]]).astype(np.int64)
+        self.document_offsets = np.searchsorted(
+            self.chunks["document"], np.arange(len(self.document_ids) + 1), side="left"
+        ).astype(np.int64)
+
+    def _open_array(self, name, dtype):
+        file_path = os.path.join(self.path, name)
+        num_rows = os.path.getsize(file_path) // dtype.itemsize
+        if num_rows == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode="r", shape=(num_rows,))
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def token_ids(self, start=0, stop=None):
+        """
+        the token ids of chunks start to stop
+        """
+        stop = len(self) if stop is None else stop
+        return TokenIds(self.tokens, self.token_starts[start:stop], self.token_ends[start:stop])
@@ -0,0 +1,98 @@
+"""
+Command line tool that cleans, chunks and tokenizes a corpus into a token shard
+
+The shard (see token_shards.py) holds the token ids of every chunk, so the corpus can be scored
+any number of times with `index_corpus.py --from-tokens` without reading and tokenizing the
+documents again. Documents are read and chunked exactly like index_corpus.py does; like there,
+an interrupted run continues where it stopped when started again with the same arguments.
+
+Usage:
+    python tokenize_corpus.py --output shard/ corpus_dir/ more_documents.jsonl.gz
+    python index_corpus.py --output results/ --from-tokens shard/
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Bijan Ranjbar (MyDataExpert)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import argparse
+import multiprocessing
+
+from tqdm.autonotebook import tqdm
+import tokenizers
+
+from sdg_util import config
+from index_corpus import Checkpoint, text_batches
+from token_shards import TokenShardWriter, TOKEN_DTYPES
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokenize a corpus of documents into a token shard")
+    parser.add_argument("inputs", nargs="+", help="text files, .jsonl files (optionally gzipped) or directories")
+    parser.add_argument("--output", required=True, help="shard directory")
+    parser.add_argument("--vocab", default=config.VOCAB_PATH)
+    parser.add_argument("--id-field", default="id", help="document id field in .jsonl files")
+    parser.add_argument("--text-field", default="text", help="document text field in .jsonl files")
+    parser.add_argument("--batch-documents", type=int, default=256, help="documents per batch (and per checkpoint)")
+    parser.add_argument("--max-tokens", type=int, default=0,
+                        help="split documents into chunks of at most this many tokens (at most %i) "
+                             "instead of 400 words" % config.MAX_LEN)
+    parser.add_argument("--overlap", type=int, default=0, help="tokens shared by consecutive chunks with --max-tokens")
+    parser.add_argument("--chunk-processes", type=int, default=0,
+                        help="processes that clean and chunk the documents (not used with --max-tokens)")
+    parser.add_argument("--token-dtype", default="int16", choices=TOKEN_DTYPES,
+                        help="int16 holds vocabularies of up to 32768 tokens, like the BERT vocabulary")
+    args = parser.parse_args()
+    if args.max_tokens > config.MAX_LEN:
+        parser.error("--max-tokens can be at most %i" % config.MAX_LEN)
+
+    tokenizer = tokenizers.BertWordPieceTokenizer(args.vocab, lowercase=True)
+    checkpoint = Checkpoint(args.output)
+    if checkpoint.documents_done:
+        print("resuming after %i documents" % checkpoint.documents_done)
+
+    settings = {"max_tokens": args.max_tokens, "overlap": args.overlap if args.max_tokens else 0}
+    shard = TokenShardWriter(
+        args.output, args.token_dtype, max_len=config.MAX_LEN, settings=settings, file_sizes=checkpoint.file_sizes
+    )
+    pool = multiprocessing.Pool(args.chunk_processes) if args.chunk_processes and not args.max_tokens else None
+
+    batches = text_batches(
+        args.inputs, args.id_field, args.text_field, args.batch_documents, checkpoint.documents_done,
+        tokenizer, max_tokens=args.max_tokens, overlap=args.overlap, pool=pool
+    )
+    documents_done = checkpoint.documents_done
+    progress = tqdm(unit="documents", initial=documents_done)
+    for document_ids, df, _ in batches:
+        if "input_ids" in df:
+            input_ids = df.input_ids
+        else:
+            input_ids = [encoding.ids for encoding in tokenizer.encode_batch(list(df.text))]
+        shard.append(document_ids, df.document, df.chunk_order, df.error, input_ids)
+        shard.flush()
+        documents_done += len(document_ids)
+        checkpoint.save(documents_done, shard.files)
+        progress.update(len(document_ids))
+
+    shard.close()
+    if pool is not None:
+        pool.close()
+    progress.close()
+    print("tokenized %i documents into %s" % (documents_done, args.output))
+
+
+if __name__ == "__main__":
+    main()
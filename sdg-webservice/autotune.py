@@ -0,0 +1,167 @@
+"""
+Autotuner for the batch size and torch threads of the SDG webservice
+
+Measures the latency and throughput of the loaded model for a range of batch sizes, sequence
+lengths and torch (intra-op) thread counts on this machine, and writes the results and the best
+configuration to a JSON file (AUTOTUNE_FILE). main.py picks the configuration up at startup, and
+index_corpus.py in sdg-large-text-corpora reads the same file with --autotune-file.
+
+The format of the file and when it is used are described in tuning.py.
+
+Usage: python autotune.py [--batch-sizes 1 4 8 16 32 64] [--lengths 64 128 256 512] [--max-latency-ms 500]
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+import config
+from sdg_model import SDGconfig, load_model
+from tuning import available_cores, hardware
+
+
+def thread_counts(cores):
+    counts = [1]
+    while counts[-1] * 2 < cores:
+        counts.append(counts[-1] * 2)
+    if cores > 1:
+        counts.append(cores)
+    return counts
+
+
+def measure(model, device, batch_size, length, vocab_size, repeats):
+    """
+    Returns the median time in seconds of a forward pass over a batch of random texts of the
+    given number of tokens
+    """
+    ids = torch.randint(1000, vocab_size, (batch_size, length), dtype=torch.long)
+    ids[:, 0] = 101
+    ids[:, -1] = 102
+    ids = ids.to(device)
+    mask = torch.ones_like(ids)
+
+    times = []
+    with torch.no_grad():
+        # The first pass includes one-time allocations and is not counted
+        for _ in range(repeats + 1):
+            start = time.perf_counter()
+            model(ids, mask, mask)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - start)
+    return float(np.median(times[1:]))
+
+
+def sweep(model, device, batch_sizes, lengths, threads, vocab_size, repeats=3, max_batch_seconds=10.0):
+    """
+    Measures every combination of thread count, batch size and sequence length. Larger batches of
+    a length are skipped once a batch takes longer than max_batch_seconds.
+    """
+    results = []
+    for num_threads in threads:
+        torch.set_num_threads(num_threads)
+        for length in lengths:
+            for batch_size in batch_sizes:
+                seconds = measure(model, device, batch_size, length, vocab_size, repeats)
+                results.append({
+                    "threads": num_threads,
+                    "batch_size": batch_size,
+                    "length": length,
+                    "latency_ms": round(seconds * 1000, 2),
+                    "texts_per_second": round(batch_size / seconds, 2),
+                    "tokens_per_second": round(batch_size * length / seconds, 1),
+                })
+                print(f"{num_threads:3d} threads, batch size {batch_size:3d}, {length:3d} tokens: "
+                      f"{seconds * 1000:8.1f} ms, {batch_size / seconds:8.1f} texts/s")
+                if seconds > max_batch_seconds:
+                    break
+    return results
+
+
+def best_configuration(results, lengths, max_latency_ms=0):
+    """
+    Picks the thread count and, for every length, the batch size with the highest throughput
+    over all lengths (the same number of texts of every length), of the batches that stay within
+    max_latency_ms
+    """
+    best = None
+    for num_threads in sorted({r["threads"] for r in results}):
+        batch_sizes = {}
+        seconds_per_text = 0.0
+        for length in lengths:
+            candidates = [
+                r for r in results if r["threads"] == num_threads and r["length"] == length
+                and not (max_latency_ms and r["latency_ms"] > max_latency_ms)
+            ]
+            if not candidates:
+                break
+            fastest = max(candidates, key=lambda r: r["texts_per_second"])
+            batch_sizes[str(length)] = fastest["batch_size"]
+            seconds_per_text += 1 / fastest["texts_per_second"]
+        else:
+            throughput = len(lengths) / seconds_per_text
+            if best is None or throughput > best["texts_per_second"]:
+                best = {
+                    "torch_threads": num_threads, "batch_size": batch_sizes[str(max(lengths))],
+                    "batch_sizes": batch_sizes, "texts_per_second": round(throughput, 2)
+                }
+    return best
+
+
+def main():
+    workers = int(os.getenv("WORKERS", "1"))
+    cores_per_worker = max(1, available_cores() // workers)
+    parser = argparse.ArgumentParser(description="Tune the batch size and torch threads for this machine")
+    parser.add_argument("--output", default=config.AUTOTUNE_FILE)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[64, 128, 256, 512])
+    parser.add_argument("--threads", type=int, nargs="+", default=thread_counts(cores_per_worker),
+                        help="torch threads to try (default: powers of two up to the cores per uwsgi worker)")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-latency-ms", type=float, default=0,
+                        help="only consider batches that take at most this long")
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if config.USE_GPU else 'cpu')
+    model = load_model(device, precision=config.PRECISION, check_precision=False)
+    lengths = sorted({min(length, SDGconfig.MAX_LEN) for length in args.lengths})
+
+    start = time.perf_counter()
+    results = sweep(
+        model, device, sorted(args.batch_sizes), lengths, args.threads, SDGconfig.TOKENIZER.get_vocab_size(),
+        repeats=args.repeats
+    )
+    best = best_configuration(results, lengths, args.max_latency_ms)
+    if best is None:
+        raise SystemExit("no configuration meets the latency limit")
+
+    tuned = dict(best, hardware=hardware(device.type, workers), precision=config.PRECISION,
+                 tuned_in_seconds=round(time.perf_counter() - start, 1), results=results)
+    with open(args.output, "w") as f:
+        json.dump(tuned, f, indent=1)
+    print(f"Best: batch sizes {best['batch_sizes']} (per length) with {best['torch_threads']} torch threads "
+          f"({best['texts_per_second']} texts/s); written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
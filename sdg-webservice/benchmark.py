@@ -0,0 +1,188 @@
+"""
+Benchmark of the SDG webservice
+
+Sends requests of synthetic texts (built from the probe texts) to /sdg through the Flask test
+client, from a number of concurrent clients, and reports the texts and tokens per second, the
+p50 and p99 latency per request and the peak RSS, for the whole request and for the
+tokenization alone. The results are written to a JSON file in the same format as
+sdg-large-text-corpora/benchmark.py; with --compare they are compared with an earlier run.
+
+The fine-tuned model_2.bin is only a Git LFS pointer in a fresh checkout. When it is not
+available (or with --tiny) the service runs a randomly initialised SDGModel with a small BERT
+configuration, written to a temporary MODEL_DIR, so the benchmark works offline. The service is
+configured with the usual environment variables, except that the prediction cache and the jobs
+API are disabled, so every text runs through the model.
+
+Usage: python benchmark.py [--requests 200] [--texts-per-request 8] [--concurrency 4] [--tiny] [--compare old.json]
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import atexit
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import torch
+
+from benchmark_support import PeakRSS, compare, is_checkpoint, summarise
+
+
+def write_tiny_model(directory, vocab_path, seed=0):
+    """
+    Writes a randomly initialised SDGModel with a small BERT configuration (2 layers of 128) as a
+    model directory, with the given vocab
+    """
+    from sdg_bert import SDGModel
+    from transformers import BertConfig
+
+    with open(vocab_path, encoding="utf-8") as f:
+        vocab_size = sum(1 for _ in f)
+    torch.manual_seed(seed)
+    model_config = BertConfig(
+        vocab_size=vocab_size, hidden_size=128, num_hidden_layers=2, num_attention_heads=2, intermediate_size=512
+    )
+    model_config.to_json_file(os.path.join(directory, "config.json"))
+    torch.save({"model_state_dict": SDGModel(conf=model_config).state_dict()}, os.path.join(directory, "model.bin"))
+    shutil.copy(vocab_path, os.path.join(directory, "vocab.txt"))
+
+
+def configure(tiny, seed):
+    """
+    Sets the environment for the service before config.py reads it. Returns the name of the
+    model that is benchmarked.
+    """
+    model_dir = os.getenv("MODEL_DIR", "../models")
+    model_path = os.path.join(model_dir, os.getenv("MODEL_FILE", "model_2.bin"))
+    if not tiny and not is_checkpoint(model_path):
+        print(f"{model_path} is not available (a Git LFS pointer?), using a randomly initialised small model")
+        tiny = True
+    if tiny:
+        directory = tempfile.mkdtemp(prefix="sdg-tiny-model-")
+        atexit.register(shutil.rmtree, directory, ignore_errors=True)
+        write_tiny_model(directory, os.path.join(model_dir, os.getenv("VOCAB_FILE", "bert-base-uncased-vocab.txt")), seed)
+        os.environ.update(MODEL_DIR=directory, MODEL_FILE="model.bin", CONFIG_FILE="config.json",
+                          VOCAB_FILE="vocab.txt", TORCHSCRIPT_FILE="")
+
+    os.environ.setdefault("USE_GPU", "YES" if torch.cuda.is_available() else "NO")
+    os.environ.update(CACHE_SIZE="0", CACHE_DB_PATH="", JOBS_DB_PATH="", AUTOTUNE="NO")
+    return "tiny" if tiny else model_path
+
+
+def synthetic_texts(num_texts, max_sentences, texts, seed=0):
+    """
+    Texts of 1 to max_sentences sentences drawn from the given texts
+    """
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(texts) for _ in range(rng.randint(1, max_sentences))) for _ in range(num_texts)]
+
+
+def run_step(name, requests, step, concurrency, tokens):
+    """
+    Calls step(texts) for every request from `concurrency` threads and times every call
+    """
+    def timed(texts):
+        start = time.perf_counter()
+        step(texts)
+        return time.perf_counter() - start
+
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            latencies = list(executor.map(timed, requests))
+        seconds = time.perf_counter() - start
+    return summarise(name, latencies, sum(len(texts) for texts in requests), tokens, rss.peak, seconds=seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /sdg of the webservice")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--texts-per-request", type=int, default=8)
+    parser.add_argument("--max-sentences", type=int, default=12, help="sentences per synthetic text (at most)")
+    parser.add_argument("--concurrency", type=int, default=4, help="clients sending requests at the same time")
+    parser.add_argument("--warmup", type=int, default=5, help="requests sent before measuring")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tiny", action="store_true",
+                        help="use a randomly initialised small model, also when the model in MODEL_DIR is available")
+    parser.add_argument("--output", default=f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    parser.add_argument("--compare", help="results of an earlier run")
+    args = parser.parse_args()
+
+    model_name = configure(args.tiny, args.seed)
+    import config
+    import main as service
+    from sdg_model import PROBE_TEXTS, SDGconfig
+
+    texts = synthetic_texts(args.requests * args.texts_per_request, args.max_sentences, PROBE_TEXTS, args.seed)
+    requests = [texts[i:i + args.texts_per_request] for i in range(0, len(texts), args.texts_per_request)]
+    tokens = sum(min(len(encoding.ids), SDGconfig.MAX_LEN) for encoding in SDGconfig.TOKENIZER.encode_batch(texts))
+    print(f"{len(requests)} requests of {args.texts_per_request} texts, {tokens} tokens, model {model_name}")
+
+    local = threading.local()
+
+    def post(request_texts):
+        if not hasattr(local, "client"):
+            local.client = service.app.test_client()
+        response = local.client.post("/sdg", json={"data": [{str(i): text} for i, text in enumerate(request_texts)]})
+        if response.status_code != 200:
+            raise RuntimeError(f"/sdg returned {response.status_code}: {response.get_data(as_text=True)}")
+
+    for request_texts in requests[:args.warmup]:
+        post(request_texts)
+
+    results = {
+        "tokenization": run_step("tokenization", requests, service.prepare, 1, tokens),
+        "sdg": run_step("/sdg", requests, post, args.concurrency, tokens),
+    }
+
+    report = {
+        "benchmark": "webservice",
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "model": model_name,
+        "hardware": {
+            "cores": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(),
+            "machine": platform.machine(),
+            "device": service.device.type,
+            "torch_threads": torch.get_num_threads(),
+            "torch": torch.__version__,
+        },
+        "settings": dict(
+            {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+            batch_size=config.BATCH_SIZE, scheduler_max_batch_size=config.SCHEDULER_MAX_BATCH_SIZE,
+            scheduler_max_wait_ms=config.SCHEDULER_MAX_WAIT_MS, precision=config.PRECISION,
+            dynamic_padding=config.DYNAMIC_PADDING, packing_max_len=config.PACKING_MAX_LEN,
+        ),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Measurements shared by the benchmarks of the SDG webservice (benchmark.py) and the corpus indexer
+(sdg-large-text-corpora/benchmark.py, which imports this module from here)
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import platform
+import threading
+
+import numpy as np
+
+LFS_POINTER = b"version https://git-lfs"
+
+
+def is_checkpoint(path):
+    """
+    Whether path holds model weights (and not a Git LFS pointer)
+    """
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(LFS_POINTER)) != LFS_POINTER
+
+
+class PeakRSS:
+    """
+    Samples the resident set size of this process while the block runs; peak is in bytes
+    (without /proc, the peak of the whole process so far)
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+
+    def current(self):
+        # Not available on Windows, where the benchmarks do not run
+        import resource
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * resource.getpagesize()
+        except OSError:
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            scale = 1 if platform.system() == "Darwin" else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self):
+        self.peak = self.current()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def summarise(name, latencies, texts, tokens, peak_rss, unit="texts", seconds=None):
+    """
+    Prints and returns the throughput, the latency percentiles of the calls (requests or batches)
+    and the peak RSS of a benchmark step. The throughput is over `seconds` of wall time, by default
+    the sum of the latencies (of calls made one after the other).
+    """
+    seconds = sum(latencies) if seconds is None else seconds
+    p50, p99 = np.percentile(latencies, [50, 99]) if latencies else (0.0, 0.0)
+    summary = {
+        "unit": unit,
+        "calls": len(latencies),
+        "texts": texts,
+        "tokens": tokens,
+        "seconds": round(seconds, 4),
+        "texts_per_second": round(texts / seconds, 2) if seconds else 0.0,
+        "tokens_per_second": round(tokens / seconds, 1) if seconds else 0.0,
+        "p50_ms": round(p50 * 1000, 3),
+        "p99_ms": round(p99 * 1000, 3),
+        "peak_rss_mb": round(peak_rss / 2 ** 20, 1),
+    }
+    print(f"{name:15s} {summary['texts_per_second']:10.1f} {unit}/s {summary['tokens_per_second']:12.1f} tokens/s   "
+          f"p50 {summary['p50_ms']:9.2f} ms   p99 {summary['p99_ms']:9.2f} ms   peak RSS {summary['peak_rss_mb']:8.1f} MB")
+    return summary
+
+
+def compare(results, previous):
+    """
+    Prints the throughput and p99 latency of every benchmark step relative to an earlier run
+    """
+    print(f"Compared with {previous.get('created')} ({previous.get('model')}), ratios above 1 are improvements:")
+    for name, summary in results.items():
+        before = previous.get("results", {}).get(name)
+        if not before or not before["texts_per_second"] or not summary["p99_ms"]:
+            continue
+        print(f"{name:15s} throughput {summary['texts_per_second'] / before['texts_per_second']:6.2f}x   "
+              f"p99 latency {before['p99_ms'] / summary['p99_ms']:6.2f}x")
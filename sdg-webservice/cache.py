@@ -0,0 +1,223 @@
+"""
+Prediction cache for the SDG webservice
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+
+import numpy as np
+
+
+def normalise_text(text):
+    """
+    Strips leading and trailing whitespace, which the tokenizer ignores. Anything else may change
+    the tokens the model sees, so texts are otherwise cached as they are.
+    """
+    return text.strip()
+
+
+def file_identity(path):
+    """
+    Identifies a file by its name, size and modification time (only its name when it is missing)
+    """
+    try:
+        stat = os.stat(path)
+        return f"{os.path.basename(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+    except OSError:
+        return os.path.basename(path)
+
+
+def model_identity(path, precision, dynamic_padding, packing_max_len, torchscript_path=None):
+    """
+    Identifies the loaded model by its file, its precision, the backend that runs it (the
+    TorchScript export at torchscript_path, or the eager model without one) and the way texts are
+    batched (which changes the scores slightly), so that cache entries of another model or
+    configuration are never used
+    """
+    backend = f"torchscript={file_identity(torchscript_path)}" if torchscript_path else "eager"
+    settings = f"{precision}:{backend}:padding={'dynamic' if dynamic_padding else 'max'}:packing={packing_max_len}"
+    return f"{file_identity(path)}:{settings}"
+
+
+def text_key(model_id, text):
+    """
+    Key of a text scored by a model: a hash of the model identity and the normalised text
+    """
+    return hashlib.sha256((model_id + "\0" + normalise_text(text)).encode("utf-8")).hexdigest()
+
+
+class PredictionCache:
+    """
+    Cache of SDG scores keyed by a hash of the normalised text and the model identity. Entries are
+    kept in an in-process LRU of at most `max_entries` texts and, when `db_path` is set, in an
+    SQLite database that can be shared by all uwsgi workers (holding at most `db_max_entries`
+    texts; the least recently used are evicted first). New entries are written to the database by
+    a thread of its own, so put_many never waits for SQLite.
+    """
+    EVICT_EVERY = 1000
+
+    def __init__(self, model_id, max_entries, db_path=None, db_max_entries=1000000):
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.db_max_entries = db_max_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.puts_since_eviction = 0
+        self.writes = None
+        self.writer_pid = None
+        self.writer_lock = threading.Lock()
+
+        if self.db_path:
+            self._db().execute(
+                "CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, scores BLOB, last_used REAL)"
+            )
+            self._db().execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+
+    def key(self, text):
+        return text_key(self.model_id, text)
+
+    def _db(self):
+        # One connection per thread (and per process, as connections must not cross a fork)
+        if getattr(self.local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def get_many(self, keys):
+        """
+        Returns the cached scores for every key, or None for keys that are not cached
+        """
+        results = [None] * len(keys)
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    results[i] = self.memory[key]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        found = {}
+        if self.db_path and missing:
+            found = self._db_get([keys[i] for i in missing])
+            for i in missing:
+                if keys[i] in found:
+                    results[i] = found[keys[i]]
+            self._memory_put(found)
+
+        with self.lock:
+            self.hits += len(keys) - len(missing) + len(found)
+            self.disk_hits += len(found)
+            self.misses += len(missing) - len(found)
+        return results
+
+    def put_many(self, keys, scores):
+        entries = {key: np.asarray(row, dtype=np.float32) for key, row in zip(keys, scores)}
+        self._memory_put(entries)
+        if self.db_path:
+            self._writer().put(entries)
+
+    def _writer(self):
+        # Started lazily (and restarted after a fork), like the inference scheduler
+        with self.writer_lock:
+            if self.writer_pid != os.getpid():
+                self.writes = queue.Queue()
+                self.writer_pid = os.getpid()
+                threading.Thread(target=self._write_entries, args=(self.writes,), daemon=True).start()
+            return self.writes
+
+    def _write_entries(self, writes):
+        while True:
+            entries = writes.get()
+            try:
+                self._db_put(entries)
+            except Exception:
+                traceback.print_exc()
+
+    def _memory_put(self, entries):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            for key, row in entries.items():
+                self.memory[key] = row
+                self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def _db_get(self, keys):
+        found = {}
+        db = self._db()
+        # Stay below SQLite's limit on the number of parameters per statement
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = db.execute(
+                "SELECT key, scores FROM predictions WHERE key IN (%s)" % ",".join("?" * len(batch)), batch
+            ).fetchall()
+            for key, scores in rows:
+                found[key] = np.frombuffer(scores, dtype=np.float32)
+            if rows:
+                db.execute(
+                    "UPDATE predictions SET last_used = ? WHERE key IN (%s)" % ",".join("?" * len(rows)),
+                    [time.time()] + [key for key, _ in rows]
+                )
+        return found
+
+    def _db_put(self, entries):
+        now = time.time()
+        db = self._db()
+        db.executemany(
+            "INSERT OR REPLACE INTO predictions (key, scores, last_used) VALUES (?, ?, ?)",
+            [(key, row.tobytes(), now) for key, row in entries.items()]
+        )
+
+        with self.lock:
+            self.puts_since_eviction += len(entries)
+            evict = self.puts_since_eviction >= self.EVICT_EVERY
+            if evict:
+                self.puts_since_eviction = 0
+        if evict:
+            excess = db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0] - self.db_max_entries
+            if excess > 0:
+                db.execute(
+                    "DELETE FROM predictions WHERE key IN "
+                    "(SELECT key FROM predictions ORDER BY last_used LIMIT ?)", (excess,)
+                )
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory),
+            }
@@ -2,15 +2,54 @@ import os
 MODEL_DIR = os.getenv("MODEL_DIR", "../models")
 MODEL_FILE = os.getenv("MODEL_FILE", "model_2.bin")
 VOCAB_FILE = os.getenv("VOCAB_FILE", "bert-base-uncased-vocab.txt")
+CONFIG_FILE = os.getenv("CONFIG_FILE", "bert-base-uncased-config.json")
+TORCHSCRIPT_FILE = os.getenv("TORCHSCRIPT_FILE", os.path.splitext(MODEL_FILE)[0] + ".torchscript.pt")
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", "16"))
+DYNAMIC_PADDING = os.getenv("DYNAMIC_PADDING", "YES") == "YES"
+PACKING_MAX_LEN = min(int(os.getenv("PACKING_MAX_LEN", "0")), 512)
+SCHEDULER_MAX_BATCH_SIZE = int(os.getenv("SCHEDULER_MAX_BATCH_SIZE", str(BATCH_SIZE)))
+SCHEDULER_MAX_WAIT_MS = float(os.getenv("SCHEDULER_MAX_WAIT_MS", "10"))
 USE_GPU = os.getenv("USE_GPU", "YES") == "YES"
+PRECISION = os.getenv("PRECISION", "fp32").lower()
+PRECISION_CHECK = os.getenv("PRECISION_CHECK", "YES") == "YES"
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", "0"))
+STREAM_PREFETCH_BATCHES = int(os.getenv("STREAM_PREFETCH_BATCHES", "2"))
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "10000"))
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "")
+CACHE_DB_MAX_ENTRIES = int(os.getenv("CACHE_DB_MAX_ENTRIES", "1000000"))
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "")
+JOBS_STALE_SECONDS = float(os.getenv("JOBS_STALE_SECONDS", "300"))
+FEATURE_STORE_PATH = os.getenv("FEATURE_STORE_PATH", "")
+FEATURE_DTYPE = os.getenv("FEATURE_DTYPE", "float16")
+AUTOTUNE = os.getenv("AUTOTUNE", "NO") == "YES"
+AUTOTUNE_FILE = os.getenv("AUTOTUNE_FILE", "autotune.json")
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_RUNS = int(os.getenv("PROFILE_RUNS", "0"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+SLOW_REQUEST_LOG = os.getenv("SLOW_REQUEST_LOG", "")
 LISTEN_PORT = int(os.getenv("LISTEN_PORT", "5000"))
 
 MODEL_PATH = os.path.join(MODEL_DIR, MODEL_FILE)
 VOCAB_PATH = os.path.join(MODEL_DIR, VOCAB_FILE)
+CONFIG_PATH = os.path.join(MODEL_DIR, CONFIG_FILE)
+TORCHSCRIPT_PATH = os.path.join(MODEL_DIR, TORCHSCRIPT_FILE) if TORCHSCRIPT_FILE else ""
+# Batch size per sequence length, set from AUTOTUNE_FILE unless BATCH_SIZE is set (see main.apply_tuned_settings)
+BATCH_SIZES = {}
 
 print(f"SDG WEBSERVICE STARTING")
 print(f"Model dir: {MODEL_DIR}")
-print(f"Using model {MODEL_PATH}, vocab {VOCAB_PATH}")
-print(f"For inference, use GPU: {USE_GPU}, batch size {BATCH_SIZE}")
+print(f"Using model {MODEL_PATH}, vocab {VOCAB_PATH}, config {CONFIG_PATH}")
+print(f"For inference, use GPU: {USE_GPU}, precision {PRECISION}, batch size {BATCH_SIZE}, dynamic padding: {DYNAMIC_PADDING}")
+print(f"Packing short texts into sequences of up to {PACKING_MAX_LEN} tokens" if PACKING_MAX_LEN else "Sequence packing disabled")
+print(f"Torch threads per uwsgi worker: {TORCH_THREADS if TORCH_THREADS else 'CPU cores divided by the number of workers'}")
+print(f"Sharing batches between requests: up to {SCHEDULER_MAX_BATCH_SIZE} texts, waiting at most {SCHEDULER_MAX_WAIT_MS} ms")
+print(f"Caching up to {CACHE_SIZE} predictions in memory" + (f" and {CACHE_DB_MAX_ENTRIES} in {CACHE_DB_PATH}" if CACHE_DB_PATH else ""))
+print(f"Jobs are stored in {JOBS_DB_PATH}" if JOBS_DB_PATH else "Jobs API disabled")
+print(f"Storing {FEATURE_DTYPE} features of scored texts in {FEATURE_STORE_PATH}" if FEATURE_STORE_PATH else "Feature store disabled")
+print(f"Tuned settings are read from {AUTOTUNE_FILE}" + (", tuning at startup when it does not match this machine" if AUTOTUNE else ""))
+print(f"Profiling the first {PROFILE_RUNS} model runs of every worker into {PROFILE_DIR}" if PROFILE_RUNS else "Profiling at startup disabled")
+print(f"Profiling can be started with POST /profile, profiles are written to {PROFILE_DIR}" if PROFILE_TOKEN else "Profiling endpoint disabled")
+print(f"Logging requests that take at least {SLOW_REQUEST_MS} ms to {SLOW_REQUEST_LOG or 'standard output'}" if SLOW_REQUEST_MS else "Slow request log disabled")
 print(f"Going to listen op port {LISTEN_PORT}")
\ No newline at end of file
@@ -0,0 +1,57 @@
+"""
+Exports the fine-tuned SDG model to a traced TorchScript file, which the webservice and the
+corpus scripts load instead of building the model with transformers when it is present.
+
+Usage: python export_torchscript.py [--precision fp32|int8] [--device cpu|cuda] [--output PATH]
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from sdg_model import PROBE_TEXTS, checkpoint_identity, load_model, predict, prepare_batches
+import argparse
+import config
+import json
+import numpy as np
+import torch
+
+parser = argparse.ArgumentParser(description="Export the SDG model to TorchScript")
+parser.add_argument("--precision", default=config.PRECISION, choices=["fp32", "int8"])
+parser.add_argument("--device", default="cuda" if config.USE_GPU else "cpu", choices=["cpu", "cuda"])
+parser.add_argument("--output", default=config.TORCHSCRIPT_PATH)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+model = load_model(device, precision=args.precision, check_precision=False, torchscript=False)
+
+# The traced graph does not depend on the batch size or sequence length of the example
+batches, _ = prepare_batches(PROBE_TEXTS[:2], batch_size=2)
+example = tuple(batches[0][key].to(device) for key in ('ids', 'mask', 'token_type_ids'))
+
+with torch.no_grad():
+    traced = torch.jit.trace(model, example)
+    # Freezing inlines the weights as constants so the graph can be optimised (torch >= 1.8)
+    if hasattr(torch.jit, 'freeze'):
+        traced = torch.jit.freeze(traced)
+
+deviation = np.abs(
+    predict(model, PROBE_TEXTS, device, config.BATCH_SIZE) - predict(traced, PROBE_TEXTS, device, config.BATCH_SIZE)
+).max()
+print(f"Maximum score deviation of the TorchScript model on the probe texts: {deviation:.6f}")
+
+metadata = {'precision': args.precision, 'device': device.type, 'checkpoint': checkpoint_identity(config.MODEL_PATH)}
+torch.jit.save(traced, args.output, _extra_files={'metadata': json.dumps(metadata)})
+print(f"TorchScript model written to {args.output}")
@@ -0,0 +1,142 @@
+"""
+Feature store for the SDG webservice
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import queue
+import threading
+import traceback
+
+import numpy as np
+
+FEATURES_FILE = "features.bin"
+KEYS_FILE = "keys.txt"
+META_FILE = "store.json"
+LOCK_FILE = "store.lock"
+
+
+class FeatureStore:
+    """
+    Append-only store of the CLS features (see SDGModel.cls_features) of the scored texts, so that
+    a new classification head can score them later without running BERT again (see
+    rescore_features.py in sdg-large-text-corpora). The directory holds the features as one
+    contiguous matrix in features.bin, the text hash (as used by the prediction cache) of every row
+    in keys.txt, and the data type, number of columns and model in store.json.
+
+    All uwsgi workers can append to the same directory; writes are serialised with a lock file.
+    Every worker stores a text only once, but a text scored by several workers can occur more
+    than once. Rows are appended by a thread of its own, so put_many never waits for the disk.
+    """
+    def __init__(self, path, model_id, num_columns, dtype="float16"):
+        if dtype not in ("float16", "float32"):
+            raise ValueError("dtype should be float16 or float32")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.num_columns = num_columns
+        self.lock = threading.Lock()
+        self.writes = None
+        self.writer_pid = None
+        self.writer_lock = threading.Lock()
+
+        meta = {"score_dtype": dtype, "num_columns": num_columns, "model": model_id}
+        with self._locked():
+            meta_path = os.path.join(path, META_FILE)
+            if os.path.exists(meta_path):
+                with open(meta_path) as f:
+                    stored = json.load(f)
+                if stored != meta:
+                    raise ValueError(f"{path} holds features of another model or type: {stored}")
+            else:
+                with open(meta_path, "w") as f:
+                    json.dump(meta, f)
+            self.keys = set(self._repair())
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.path, LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _repair(self):
+        # An interrupted append can leave features without keys (or the other way around); both
+        # files are cut back to the rows they have in common
+        features_path = os.path.join(self.path, FEATURES_FILE)
+        keys_path = os.path.join(self.path, KEYS_FILE)
+        row_size = self.dtype.itemsize * self.num_columns
+        num_rows = os.path.getsize(features_path) // row_size if os.path.exists(features_path) else 0
+        keys = []
+        if os.path.exists(keys_path):
+            with open(keys_path) as f:
+                keys = f.read().split()
+
+        if len(keys) > num_rows:
+            keys = keys[:num_rows]
+            with open(keys_path, "w") as f:
+                f.write("".join(key + "\n" for key in keys))
+        with open(features_path, "ab") as f:
+            f.truncate(len(keys) * row_size)
+        return keys
+
+    def put_many(self, keys, features):
+        """
+        Queues the features of texts that this worker has not stored yet for appending
+        """
+        rows = {}
+        with self.lock:
+            for key, row in zip(keys, features):
+                if key not in self.keys and key not in rows:
+                    rows[key] = row
+            self.keys.update(rows)
+        if rows:
+            self._writer().put(rows)
+
+    def _writer(self):
+        # Started lazily (and restarted after a fork), like the writer of the prediction cache
+        with self.writer_lock:
+            if self.writer_pid != os.getpid():
+                self.writes = queue.Queue()
+                self.writer_pid = os.getpid()
+                threading.Thread(target=self._write_rows, args=(self.writes,), daemon=True).start()
+            return self.writes
+
+    def _write_rows(self, writes):
+        while True:
+            rows = writes.get()
+            try:
+                self._append(rows)
+            except Exception:
+                traceback.print_exc()
+
+    def _append(self, rows):
+        data = np.ascontiguousarray(np.array(list(rows.values())), dtype=self.dtype)
+        with self._locked():
+            with open(os.path.join(self.path, FEATURES_FILE), "ab") as f:
+                f.write(data.tobytes())
+            with open(os.path.join(self.path, KEYS_FILE), "a") as f:
+                f.write("".join(key + "\n" for key in rows))
+
+    def __len__(self):
+        return os.path.getsize(os.path.join(self.path, FEATURES_FILE)) // (self.dtype.itemsize * self.num_columns)
@@ -0,0 +1,255 @@
+"""
+Asynchronous bulk scoring jobs for the SDG webservice
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from concurrent.futures import TimeoutError
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+import numpy as np
+
+
+class JobStore:
+    """
+    Persistent queue of scoring jobs in an SQLite database. Every job holds its texts and, once
+    they are scored, their scores, so a job that was interrupted (for instance because the
+    container restarted) continues where it stopped. The database can be shared by all uwsgi
+    workers; a job is claimed by one worker at a time. The owner of a job refreshes its heartbeat
+    while it works on it, and a job whose heartbeat is older than `stale_after` seconds is taken
+    over by another worker. Scores and the job status are only written by the current owner.
+    """
+    def __init__(self, db_path, stale_after=300):
+        self.db_path = db_path
+        self.stale_after = stale_after
+        self.local = threading.local()
+
+        db = self._db()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, total INTEGER, done INTEGER, "
+            "created REAL, updated REAL, error TEXT, owner TEXT, heartbeat REAL)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS job_items (job_id TEXT, idx INTEGER, input_id TEXT, text TEXT, scores BLOB, "
+            "PRIMARY KEY (job_id, idx))"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    def _db(self):
+        # One connection per thread (and per process, as connections must not cross a fork)
+        if getattr(self.local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def create(self, input_ids, texts):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(
+                "INSERT INTO job_items (job_id, idx, input_id, text) VALUES (?, ?, ?, ?)",
+                [(job_id, idx, input_id, text) for idx, (input_id, text) in enumerate(zip(input_ids, texts))]
+            )
+            db.execute(
+                "INSERT INTO jobs (id, status, total, done, created, updated) VALUES (?, 'queued', ?, 0, ?, ?)",
+                (job_id, len(texts), now, now)
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return job_id
+
+    def claim(self, owner):
+        """
+        Marks the oldest queued job (or a running job whose heartbeat is older than
+        `stale_after` seconds, as its worker probably died) as running and owned by `owner`,
+        and returns its id
+        """
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' OR (status = 'running' AND heartbeat < ?) "
+                "ORDER BY created LIMIT 1", (now - self.stale_after,)
+            ).fetchone()
+            if row is not None:
+                db.execute(
+                    "UPDATE jobs SET status = 'running', owner = ?, heartbeat = ?, updated = ? WHERE id = ?",
+                    (owner, now, now, row[0])
+                )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return row[0] if row is not None else None
+
+    def heartbeat(self, job_id, owner):
+        """
+        Tells other workers that the owner is still working on the job. Returns False when the
+        job has been taken over.
+        """
+        cursor = self._db().execute(
+            "UPDATE jobs SET heartbeat = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            (time.time(), job_id, owner)
+        )
+        return cursor.rowcount > 0
+
+    def unscored_items(self, job_id, limit):
+        return self._db().execute(
+            "SELECT idx, text FROM job_items WHERE job_id = ? AND scores IS NULL ORDER BY idx LIMIT ?",
+            (job_id, limit)
+        ).fetchall()
+
+    def store_scores(self, job_id, owner, indices, scores):
+        """
+        Stores the scores of texts that have not been scored yet. Returns False (and stores
+        nothing) when the job has been taken over by another worker.
+        """
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if not self._owned(db, job_id, owner):
+                db.execute("ROLLBACK")
+                return False
+            db.executemany(
+                "UPDATE job_items SET scores = ? WHERE job_id = ? AND idx = ? AND scores IS NULL",
+                [(np.asarray(row, dtype=np.float32).tobytes(), job_id, idx) for idx, row in zip(indices, scores)]
+            )
+            db.execute(
+                "UPDATE jobs SET done = (SELECT COUNT(*) FROM job_items WHERE job_id = ? AND scores IS NOT NULL), "
+                "updated = ?, heartbeat = ? WHERE id = ?", (job_id, now, now, job_id)
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return True
+
+    def finish(self, job_id, owner, error=None):
+        self._db().execute(
+            "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            ("failed" if error else "done", error, time.time(), job_id, owner)
+        )
+
+    @staticmethod
+    def _owned(db, job_id, owner):
+        row = db.execute("SELECT owner, status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is not None and row[0] == owner and row[1] == 'running'
+
+    def status(self, job_id):
+        row = self._db().execute(
+            "SELECT id, status, total, done, created, updated, error FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        status = dict(zip(("id", "status", "total", "done", "created", "updated", "error"), row))
+        status["progress"] = status["done"] / status["total"] if status["total"] else 1.0
+        return status
+
+    def results(self, job_id):
+        """
+        Yields (input id, scores) for every text of a job, in input order
+        """
+        rows = self._db().execute(
+            "SELECT input_id, scores FROM job_items WHERE job_id = ? ORDER BY idx", (job_id,)
+        )
+        for input_id, scores in rows:
+            yield input_id, np.frombuffer(scores, dtype=np.float32)
+
+
+class JobTakenOver(Exception):
+    pass
+
+
+class JobWorker:
+    """
+    Background thread that runs queued jobs in slices of `batch_size` texts, storing the scores of
+    every slice as it goes. `submit` takes a list of texts and returns a Future for their scores;
+    while it waits (job batches only run when no interactive request is waiting) the worker keeps
+    refreshing the heartbeat of its job.
+    """
+    def __init__(self, store, submit, batch_size, poll_interval=1.0):
+        self.store = store
+        self.submit = submit
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def ensure_running(self):
+        # Started lazily (and restarted after a fork), like the inference scheduler
+        with self.start_lock:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def _predict(self, job_id, owner, texts):
+        future = self.submit(texts)
+        while True:
+            try:
+                return future.result(timeout=self.store.stale_after / 3)
+            except TimeoutError:
+                if not self.store.heartbeat(job_id, owner):
+                    raise JobTakenOver()
+
+    def _run(self):
+        owner = "%i-%s" % (os.getpid(), uuid.uuid4().hex)
+        while True:
+            try:
+                job_id = self.store.claim(owner)
+            except Exception:
+                traceback.print_exc()
+                job_id = None
+
+            if job_id is None:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+
+            try:
+                while True:
+                    items = self.store.unscored_items(job_id, self.batch_size)
+                    if not items:
+                        break
+                    indices = [idx for idx, _ in items]
+                    scores = self._predict(job_id, owner, [text for _, text in items])
+                    if not self.store.store_scores(job_id, owner, indices, scores):
+                        raise JobTakenOver()
+                self.store.finish(job_id, owner)
+            except JobTakenOver:
+                print("Job %s was taken over by another worker" % job_id)
+            except Exception as e:
+                traceback.print_exc()
+                self.store.finish(job_id, owner, error="exception %s" % e)
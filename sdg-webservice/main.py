@@ -18,40 +18,136 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 
 """
 
+from cache import PredictionCache, model_identity, text_key
+from collections import deque
+from concurrent.futures import Future
+from feature_store import FeatureStore
 from flask import Flask, Response
-from flask import request, make_response
+from flask import request, make_response, stream_with_context
 from functools import wraps
-from sdg_model import SDGModel, SDGDataset
-from tqdm.autonotebook import tqdm
-from transformers import BertConfig
-import argparse
+from jobs import JobStore, JobWorker
+from metrics import Metrics, RATIO_BUCKETS, SECONDS_BUCKETS
+from profiling import Profiler, SlowRequestLog
+from scheduler import InferenceScheduler
+from sdg_model import SDGconfig, batch_size_for, load_model, max_packing_deviation, prepare_batches, prepare_packed_batches, run_batches
+from tuning import load_tuned
+import atexit
 import config
+import gc
+import hmac
 import json
 import numpy as np
 import os
-import threading
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import torch
+import traceback
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
 
 app = Flask(__name__)
 
+JSON = 'application/json'
+NDJSON = 'application/x-ndjson'
+
 device = torch.device('cuda' if config.USE_GPU else 'cpu')
-model_config = BertConfig.from_pretrained('bert-base-uncased')
-model_config.output_hidden_states = True
 
-model = SDGModel(conf=model_config)
-model.load_state_dict(torch.load(config.MODEL_PATH, map_location=device)['model_state_dict'])
-model.eval()
-model.to(device)
+def apply_tuned_settings():
+    """
+    Uses the batch sizes and torch threads from the autotune file, for the settings that are not
+    set in the environment. With AUTOTUNE=YES the tuner is run first when there is no file for
+    this machine; it runs in its own process, so this process stays single-threaded before uwsgi
+    forks the workers.
+    """
+    workers = uwsgi.numproc if uwsgi is not None else 1
+    tuned = load_tuned(config.AUTOTUNE_FILE, device.type, config.PRECISION, workers)
+    if tuned is None and config.AUTOTUNE:
+        print("Tuning the batch size and torch threads for this machine")
+        subprocess.run(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "autotune.py"),
+             "--output", config.AUTOTUNE_FILE],
+            check=True, env=dict(os.environ, WORKERS=str(workers))
+        )
+        tuned = load_tuned(config.AUTOTUNE_FILE, device.type, config.PRECISION, workers)
+    if tuned is None:
+        return
+
+    if "BATCH_SIZE" not in os.environ:
+        config.BATCH_SIZE = tuned["batch_size"]
+        config.BATCH_SIZES = {int(length): size for length, size in tuned["batch_sizes"].items()}
+    if "SCHEDULER_MAX_BATCH_SIZE" not in os.environ:
+        # Enough texts to fill the largest batches, those of the shortest texts
+        config.SCHEDULER_MAX_BATCH_SIZE = max([config.BATCH_SIZE] + list(config.BATCH_SIZES.values()))
+    if "TORCH_THREADS" not in os.environ:
+        config.TORCH_THREADS = tuned["torch_threads"]
+    print(f"Using tuned settings from {config.AUTOTUNE_FILE}: batch size {config.BATCH_SIZE}, "
+          f"per length {config.BATCH_SIZES or 'not tuned'}, "
+          f"scheduler batch size {config.SCHEDULER_MAX_BATCH_SIZE}, torch threads {config.TORCH_THREADS or 'default'}")
+
+apply_tuned_settings()
+
+def set_worker_threads():
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    threads = config.TORCH_THREADS or max(1, cores // uwsgi.numproc)
+    torch.set_num_threads(threads)
+    print(f"uwsgi worker {uwsgi.worker_id()} uses {threads} torch threads")
 
-model_lock = threading.Lock()
+def after_fork():
+    set_worker_threads()
+    # Threads do not survive the fork: every worker polls for queued jobs from the start, not
+    # only once it has served its first request
+    if job_worker is not None:
+        job_worker.ensure_running()
+
+preforked = uwsgi is not None and uwsgi.worker_id() == 0
+if preforked:
+    # The uwsgi master loads the model before forking the workers, which share its weights
+    # copy-on-write. The master stays single-threaded (OpenMP thread pools do not survive a
+    # fork); every worker gets its share of the cores once it has been forked.
+    torch.set_num_threads(1)
+    uwsgi.post_fork_hook = after_fork
+elif uwsgi is not None:
+    set_worker_threads()
+elif config.TORCH_THREADS:
+    torch.set_num_threads(config.TORCH_THREADS)
+
+# Storing features and packing need the model itself, not a TorchScript export of its forward pass
+model = load_model(
+    device, precision=config.PRECISION, check_precision=config.PRECISION_CHECK,
+    torchscript=not (config.FEATURE_STORE_PATH or config.PACKING_MAX_LEN)
+)
+# Nothing writes to the weights, so their memory pages stay shared between the workers
+for parameter in model.parameters():
+    parameter.requires_grad_(False)
+
+if config.PACKING_MAX_LEN:
+    deviation = max_packing_deviation(model, device, config.PACKING_MAX_LEN)
+    print(f"Maximum score deviation of packed from unpacked inference: {deviation.max():.6f}")
+
+# load_model falls back to the eager model when the export does not match, so the backend is
+# taken from the model that was actually loaded
+model_id = model_identity(
+    config.MODEL_PATH, config.PRECISION, config.DYNAMIC_PADDING, config.PACKING_MAX_LEN,
+    torchscript_path=config.TORCHSCRIPT_PATH if isinstance(model, torch.jit.ScriptModule) else None
+)
+print(f"Model identity: {model_id}")
+feature_store = None
+if config.FEATURE_STORE_PATH:
+    feature_store = FeatureStore(config.FEATURE_STORE_PATH, model_id, 2 * model.nb_features, config.FEATURE_DTYPE)
+    print(f"Feature store holds {len(feature_store)} texts")
 
 def wrapped(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         resp = None
         try:
-            with model_lock:
-                resp = make_response(f(*args, **kwargs))
+            resp = make_response(f(*args, **kwargs))
 
         except Exception as e:
             traceback.print_exc()
@@ -60,7 +156,8 @@ def wrapped(f):
         # Exit on exception (so Docker can restart us)
         # os._exit(-1)
 
-        resp.headers["Content-type"] = "application/json"
+        if not resp.is_streamed:
+            resp.headers["Content-type"] = "application/json"
         resp.headers["Access-Control-Allow-Origin"] = "*"
         return resp
 
@@ -72,67 +169,353 @@ def index():
     resp = Response(json.dumps({}))
     return resp
 
-@app.route('/sdg', methods=['POST'])
+def metrics_directory():
+    """
+    METRICS_DIR, or else a new temporary directory that is removed when the process that made it
+    (the uwsgi master) exits
+    """
+    if config.METRICS_DIR:
+        return config.METRICS_DIR
+    directory = tempfile.mkdtemp(prefix="sdg-metrics-")
+    owner = os.getpid()
+
+    def remove():
+        # The workers inherit this exit handler, but only the master removes the directory
+        if os.getpid() == owner:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    atexit.register(remove)
+    return directory
+
+# Kept in one directory for all uwsgi workers, created by the master before it forks them
+metrics = Metrics(metrics_directory(), [
+    ("histogram", "sdg_queue_wait_seconds", "Time requests waited for the scheduler", SECONDS_BUCKETS),
+    ("histogram", "sdg_tokenize_seconds", "Time to tokenize and batch the texts of a model run", SECONDS_BUCKETS),
+    ("histogram", "sdg_forward_seconds", "Time of the forward passes of a model run", SECONDS_BUCKETS),
+    ("histogram", "sdg_serialise_seconds", "Time to turn the scores of a response into JSON", SECONDS_BUCKETS),
+    ("histogram", "sdg_batch_fill_ratio", "Texts per model run relative to SCHEDULER_MAX_BATCH_SIZE", RATIO_BUCKETS),
+    ("counter", "sdg_texts_total", "Texts run through the model"),
+    ("counter", "sdg_tokens_total", "Tokens of the texts run through the model"),
+    ("counter", "sdg_padding_tokens_total", "Padding tokens run through the model"),
+    ("counter", "sdg_cache_hits_total", "Texts answered from the prediction cache"),
+    ("counter", "sdg_cache_misses_total", "Texts that were not in the prediction cache"),
+    ("counter", "sdg_requests_total", "Requests received"),
+    ("gauge", "sdg_requests_in_flight", "Requests being handled"),
+])
+
+# Armed before uwsgi forks, so every worker profiles its first PROFILE_RUNS model runs
+profiler = Profiler(config.PROFILE_DIR)
+profiler.arm(config.PROFILE_RUNS)
+slow_requests = SlowRequestLog(config.SLOW_REQUEST_MS, config.SLOW_REQUEST_LOG)
+
+def prepare(texts):
+    start = time.perf_counter()
+    if config.PACKING_MAX_LEN:
+        batch_size = batch_size_for(config.PACKING_MAX_LEN, config.BATCH_SIZE, config.BATCH_SIZES)
+        batches, order = prepare_packed_batches(texts, batch_size, config.PACKING_MAX_LEN)
+    else:
+        batches, order = prepare_batches(texts, config.BATCH_SIZE, config.DYNAMIC_PADDING, config.BATCH_SIZES)
+    metrics.observe("sdg_tokenize_seconds", time.perf_counter() - start)
+
+    # The token type is 1 for every real token and 0 for padding
+    tokens = sum(int(batch['token_type_ids'].sum()) for batch in batches)
+    metrics.inc("sdg_tokens_total", tokens)
+    metrics.inc("sdg_padding_tokens_total", sum(batch['ids'].numel() for batch in batches) - tokens)
+    return batches, order, texts
+
+def run(prepared):
+    batches, order, texts = prepared
+    start = time.perf_counter()
+    with profiler.profile("run"):
+        if feature_store is None:
+            outs = run_batches(model, batches, order, device)
+        else:
+            outs, features = run_batches(model, batches, order, device, return_features=True)
+    metrics.observe("sdg_forward_seconds", time.perf_counter() - start)
+    if feature_store is not None:
+        # Only queued here: the feature store appends them on a thread of its own
+        feature_store.put_many([text_key(model_id, text) for text in texts], features)
+    metrics.observe("sdg_batch_fill_ratio", len(texts) / config.SCHEDULER_MAX_BATCH_SIZE)
+    metrics.inc("sdg_texts_total", len(texts))
+    return np.round(outs, 2)
+
+scheduler = InferenceScheduler(
+    prepare=prepare,
+    run=run,
+    max_batch_size=config.SCHEDULER_MAX_BATCH_SIZE,
+    max_wait=config.SCHEDULER_MAX_WAIT_MS / 1000.0,
+    on_wait=lambda seconds: metrics.observe("sdg_queue_wait_seconds", seconds)
+)
+
+# Batches of bulk jobs only get scheduled when no interactive request is waiting
+INTERACTIVE_PRIORITY = 0
+JOB_PRIORITY = 1
+
+cache = None
+if config.CACHE_SIZE > 0 or config.CACHE_DB_PATH:
+    cache = PredictionCache(
+        model_id,
+        max_entries=config.CACHE_SIZE,
+        db_path=config.CACHE_DB_PATH,
+        db_max_entries=config.CACHE_DB_MAX_ENTRIES
+    )
+
+def submit_cached(texts, priority=INTERACTIVE_PRIORITY, trace=None):
+    """
+    Like scheduler.submit, but texts that are in the cache are answered from the cache and only
+    the others are sent to the scheduler (each distinct text only once)
+    """
+    if cache is None:
+        return scheduler.submit(texts, priority, trace)
+
+    keys = [cache.key(text) for text in texts]
+    scores = cache.get_many(keys)
+    result = Future()
+    hits = sum(score is not None for score in scores)
+    metrics.inc("sdg_cache_hits_total", hits)
+    metrics.inc("sdg_cache_misses_total", len(scores) - hits)
+    if trace is not None:
+        trace["cache_hits"] = trace.get("cache_hits", 0) + hits
+
+    missing = {}
+    for key, text, score in zip(keys, texts, scores):
+        if score is None and key not in missing:
+            missing[key] = text
+    if not missing:
+        result.set_result(np.array(scores, dtype=np.float32).reshape(len(texts), 17))
+        return result
+
+    def merge(future):
+        try:
+            outs = future.result()
+            cache.put_many(list(missing), outs)
+            computed = dict(zip(missing, outs))
+            merged = [computed[key] if score is None else score for key, score in zip(keys, scores)]
+            result.set_result(np.array(merged, dtype=np.float32).reshape(len(texts), 17))
+        except Exception as e:
+            result.set_exception(e)
+
+    scheduler.submit(list(missing.values()), priority, trace).add_done_callback(merge)
+    return result
+
+def cached_predict(texts, trace=None):
+    return submit_cached(texts, trace=trace).result()
+
+def serialise(input_ids, outs, trace=None):
+    """
+    The JSON response body for the scores of a list of texts
+    """
+    start = time.perf_counter()
+    body = json.dumps([format_result(input_id, scores) for input_id, scores in zip(input_ids, outs)])
+    seconds = time.perf_counter() - start
+    metrics.observe("sdg_serialise_seconds", seconds)
+    if trace is not None:
+        trace["serialise"] = trace.get("serialise", 0) + seconds
+    return body
+
+def log_if_slow(path, texts, trace, started):
+    """
+    Writes the size, token counts and stage timings of a request to the slow request log when it
+    took at least SLOW_REQUEST_MS. The stage timings are those of the shared batches the request
+    was part of, added up over the batches of a streamed request.
+    """
+    seconds = time.perf_counter() - started
+    if not slow_requests.is_slow(seconds):
+        return
+
+    # Tokenizing again only costs time for the requests that are logged
+    tokens = [min(len(encoding.ids), SDGconfig.MAX_LEN) for encoding in SDGconfig.TOKENIZER.encode_batch(list(texts))]
+    entry = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "worker": os.getpid(),
+        "path": path,
+        "texts": len(texts),
+        "characters": sum(len(text) for text in texts),
+        "tokens": sum(tokens),
+        "max_tokens": max(tokens, default=0),
+        "cache_hits": trace.get("cache_hits", 0),
+        "batch_texts": trace.get("batch_texts", 0),
+        "total_ms": round(seconds * 1000, 1),
+    }
+    for stage in ("queue_wait", "prepare", "run", "serialise"):
+        entry[f"{stage}_ms"] = round(trace.get(stage, 0) * 1000, 1)
+    slow_requests.write(entry)
+
+@app.route('/cache', methods=['GET'])
 @wrapped
-def sdgModel():
+def cacheStats():
+    return Response(json.dumps(cache.stats() if cache is not None else {}))
 
-    json_input = request.get_json()['data']
-    
+def parse_input(json_input):
     texts = []
     input_ids = []
     for item in json_input:
         for key, value in item.items():
             input_ids.append(key)
             texts.append(value)
+    return input_ids, texts
+
+def format_result(input_id, scores):
+    sample_dict = dict()
+    for sdg_index in range(1, 18):
+        key = 'sdg' + str(sdg_index)
+        sample_dict[key] = str(scores[sdg_index - 1])
+    return {
+        "id": input_id,
+        "scores": sample_dict
+    }
+
+def stream_results(input_ids, texts):
+    """
+    Yields the results as NDJSON lines, one batch at a time as soon as it has been scored. A few
+    batches are submitted ahead so that the model does not wait while results are sent.
+    """
+    pending = deque()
+    started = time.perf_counter()
+    trace = {}
+    path = request.path
 
-    outs = []
+    def emit(start, future):
+        outs = future.result()
+        serialise_start = time.perf_counter()
+        lines = "".join(
+            json.dumps(format_result(input_ids[start + idx], scores)) + "\n" for idx, scores in enumerate(outs)
+        )
+        seconds = time.perf_counter() - serialise_start
+        metrics.observe("sdg_serialise_seconds", seconds)
+        trace["serialise"] = trace.get("serialise", 0) + seconds
+        return lines
 
-    test_dataset = SDGDataset(
-        abstract=texts)
+    try:
+        for start in range(0, len(texts), config.BATCH_SIZE):
+            pending.append((start, submit_cached(texts[start:start + config.BATCH_SIZE], trace=trace)))
+            if len(pending) > config.STREAM_PREFETCH_BATCHES:
+                yield emit(*pending.popleft())
+        while pending:
+            yield emit(*pending.popleft())
+        log_if_slow(path, texts, trace, started)
+    except Exception as e:
+        traceback.print_exc()
+        yield json.dumps({"error": "exception %s" % e}) + "\n"
 
-    test_data_loader = torch.utils.data.DataLoader(
-        test_dataset,
-        batch_size=config.BATCH_SIZE,
-        num_workers=1,
-        shuffle=False
+def stream_response(input_ids, texts):
+    return Response(stream_with_context(stream_results(input_ids, texts)), mimetype=NDJSON)
+
+@app.route('/sdg', methods=['POST'])
+@wrapped
+def sdgModel():
+
+    started = time.perf_counter()
+    json_input = request.get_json()['data']
+    input_ids, texts = parse_input(json_input)
+
+    if request.accept_mimetypes.best_match([JSON, NDJSON]) == NDJSON:
+        return stream_response(input_ids, texts)
+
+    trace = {}
+    outs = cached_predict(texts, trace)
+
+    resp = Response(serialise(input_ids, outs, trace))
+    log_if_slow(request.path, texts, trace, started)
+    return resp
+
+@app.route('/sdg/stream', methods=['POST'])
+@wrapped
+def sdgModelStream():
+    json_input = request.get_json()['data']
+    input_ids, texts = parse_input(json_input)
+    return stream_response(input_ids, texts)
+
+
+job_store = None
+job_worker = None
+if config.JOBS_DB_PATH:
+    job_store = JobStore(config.JOBS_DB_PATH, stale_after=config.JOBS_STALE_SECONDS)
+    job_worker = JobWorker(
+        job_store,
+        lambda texts: submit_cached(texts, JOB_PRIORITY),
+        batch_size=config.BATCH_SIZE
     )
-    tk0 = tqdm(test_data_loader, total=len(test_data_loader))
-    with torch.no_grad():
-        for bi, d in enumerate(tk0):
-            ids = d["ids"]
-            token_type_ids = d["token_type_ids"]
-            mask = d["mask"]
-
-            ids = ids.to(device, dtype=torch.long)
-            token_type_ids = token_type_ids.to(device, dtype=torch.long)
-            mask = mask.to(device, dtype=torch.long)
-
-            preds = model(
-                ids=ids,
-                mask=mask,
-                token_type_ids=token_type_ids,
-            )
-
-            outs.append(np.round(torch.sigmoid(preds).cpu().detach().numpy(), 2))
-
-    outs = np.vstack(outs)
-    
-    output_dict = dict()
-    results = []
-    for idx, text in enumerate(texts):
-        sample_dict = dict()
-        for sdg_index in range(1, 18):
-            key = 'sdg' + str(sdg_index)
-            value = str(outs[:, sdg_index - 1][idx])
-            sample_dict[key] = value
-        results.append({
-            "id": input_ids[idx],
-            "scores": sample_dict
-        })
-
-    resp = Response(json.dumps(results))
+    if not preforked:
+        job_worker.ensure_running()
+
+@app.before_request
+def count_request():
+    if request.path != '/metrics':
+        metrics.inc("sdg_requests_total")
+        metrics.inc("sdg_requests_in_flight")
+
+@app.after_request
+def finish_request(resp):
+    # Called once the response (also a streamed one) has been sent
+    if request.path != '/metrics':
+        resp.call_on_close(lambda: metrics.inc("sdg_requests_in_flight", -1))
     return resp
 
+@app.route('/metrics', methods=['GET'])
+def metricsEndpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profile', methods=['POST'])
+@wrapped
+def profileRuns():
+    # Profiling writes files and slows requests down, so it needs the token from PROFILE_TOKEN
+    token = request.headers.get("X-Profile-Token", "")
+    if not config.PROFILE_TOKEN or not hmac.compare_digest(token, config.PROFILE_TOKEN):
+        resp = Response(json.dumps({"error": "profiling is disabled or the token is wrong"}))
+        resp.status_code = 403
+        return resp
+
+    runs = int(request.args.get("runs", "1"))
+    profiler.arm(runs)
+    return Response(json.dumps({"runs": runs, "directory": config.PROFILE_DIR, "worker": os.getpid()}))
+
+def job_not_found(job_id):
+    resp = Response(json.dumps({"error": "job %s not found" % job_id}))
+    resp.status_code = 404
+    return resp
+
+@app.route('/jobs', methods=['POST'])
+@wrapped
+def submitJob():
+    if job_store is None:
+        raise Exception("the jobs API is disabled (JOBS_DB_PATH is not set)")
+
+    json_input = request.get_json()['data']
+    input_ids, texts = parse_input(json_input)
+    job_id = job_store.create(input_ids, texts)
+    job_worker.notify()
+
+    resp = Response(json.dumps(job_store.status(job_id)))
+    resp.status_code = 202
+    return resp
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@wrapped
+def jobStatus(job_id):
+    status = job_store.status(job_id) if job_store is not None else None
+    if status is None:
+        return job_not_found(job_id)
+    return Response(json.dumps(status))
+
+@app.route('/jobs/<job_id>/results', methods=['GET'])
+@wrapped
+def jobResults(job_id):
+    status = job_store.status(job_id) if job_store is not None else None
+    if status is None:
+        return job_not_found(job_id)
+    if status["status"] != "done":
+        resp = Response(json.dumps(status))
+        resp.status_code = 409
+        return resp
+
+    results = [format_result(input_id, scores) for input_id, scores in job_store.results(job_id)]
+    return Response(json.dumps(results))
+
+
+if preforked and hasattr(gc, 'freeze'):
+    # Keeps the garbage collector from touching (and so copying) the objects created at startup
+    gc.freeze()
 
 if __name__ == "__main__":
     print("SDG server is running")
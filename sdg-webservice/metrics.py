@@ -0,0 +1,147 @@
+"""
+Prometheus metrics for the SDG webservice
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from bisect import bisect_left
+import glob
+import os
+import threading
+
+import numpy as np
+
+SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+RATIO_BUCKETS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms in the Prometheus text format. Every process keeps its values
+    in a small memory-mapped file in `directory`, so an update is only a few additions, and
+    render() adds up the files of all uwsgi workers (counters and histograms of workers that have
+    stopped are kept, gauges only count for running workers).
+
+    `definitions` is a list of (type, name, help) for counters and gauges and (type, name, help,
+    buckets) for histograms.
+    """
+    def __init__(self, directory, definitions):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.definitions = definitions
+        self.offsets = {}
+        self.buckets = {}
+        size = 0
+        for definition in definitions:
+            self.offsets[definition[1]] = size
+            if definition[0] == "histogram":
+                self.buckets[definition[1]] = definition[3]
+                # a count per bucket (and one for +Inf) and the sum of the values
+                size += len(definition[3]) + 2
+            else:
+                size += 1
+        self.size = size
+        self.lock = threading.Lock()
+        self.values = None
+        self.pid = None
+
+        # Files of processes that are gone are left over from an earlier run
+        for path in self._files():
+            if not pid_alive(self._file_pid(path)):
+                os.remove(path)
+
+    def _files(self):
+        return glob.glob(os.path.join(self.directory, "*.metrics"))
+
+    @staticmethod
+    def _file_pid(path):
+        return int(os.path.basename(path).split(".")[0])
+
+    def _values(self):
+        # Every process gets its own file (also after a fork)
+        if self.pid != os.getpid():
+            path = os.path.join(self.directory, f"{os.getpid()}.metrics")
+            self.values = np.memmap(path, dtype=np.float64, mode="w+", shape=(self.size,))
+            self.pid = os.getpid()
+        return self.values
+
+    def inc(self, name, amount=1.0):
+        """
+        Adds to a counter or gauge
+        """
+        with self.lock:
+            self._values()[self.offsets[name]] += amount
+
+    def observe(self, name, value):
+        """
+        Adds a value to a histogram
+        """
+        buckets = self.buckets[name]
+        offset = self.offsets[name]
+        with self.lock:
+            values = self._values()
+            values[offset + bisect_left(buckets, value)] += 1
+            values[offset + len(buckets) + 1] += value
+
+    def collect(self):
+        """
+        Returns the values of all processes added up
+        """
+        totals = np.zeros(self.size)
+        gauges = np.zeros(self.size)
+        for path in self._files():
+            values = np.fromfile(path, dtype=np.float64)
+            if len(values) != self.size:
+                continue
+            totals += values
+            if pid_alive(self._file_pid(path)):
+                gauges += values
+        for definition in self.definitions:
+            if definition[0] == "gauge":
+                totals[self.offsets[definition[1]]] = gauges[self.offsets[definition[1]]]
+        return totals
+
+    def render(self):
+        totals = self.collect()
+        lines = []
+        for definition in self.definitions:
+            kind, name, description = definition[:3]
+            offset = self.offsets[name]
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                lines.append(f"{name} {float(totals[offset])!r}")
+                continue
+
+            buckets = definition[3]
+            counts = np.cumsum(totals[offset:offset + len(buckets) + 1])
+            for bound, count in zip(buckets, counts):
+                lines.append(f'{name}_bucket{{le="{bound:g}"}} {float(count)!r}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {float(counts[-1])!r}')
+            lines.append(f"{name}_sum {float(totals[offset + len(buckets) + 1])!r}")
+            lines.append(f"{name}_count {float(counts[-1])!r}")
+        return "\n".join(lines) + "\n"
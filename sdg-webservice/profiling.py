@@ -0,0 +1,145 @@
+"""
+On-demand profiling and the slow request log of the SDG webservice and the corpus indexer
+
+This is the only copy: the corpus scripts in sdg-large-text-corpora import it from here (sdg_util.py
+puts this directory on their path).
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+
+import torch
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the Python stacks of all other threads every `interval` seconds and counts them in
+    the collapsed format of flamegraph.pl and speedscope (one line per distinct stack, with the
+    frames from the thread down to the innermost function separated by semicolons).
+    """
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(frames))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """
+    Profiles the next model runs after arm() was called. For every profiled run it writes three
+    files to `directory`: the torch operators as a Chrome trace (.trace.json, for
+    chrome://tracing or Perfetto), the operators added up per type (.ops.txt), and the sampled
+    Python stacks of all threads (.stacks.txt). Runs that are not profiled only pay for reading
+    a counter.
+    """
+    def __init__(self, directory, stack_interval=0.005):
+        self.directory = directory
+        self.stack_interval = stack_interval
+        self.remaining = 0
+        self.profiled = 0
+        self.lock = threading.Lock()
+
+    def arm(self, runs):
+        """
+        Profiles the next `runs` runs (0 stops profiling)
+        """
+        with self.lock:
+            self.remaining = runs
+
+    def _take(self):
+        # Returns the number of the profile to take, or None when the run is not profiled
+        with self.lock:
+            if self.remaining <= 0:
+                return None
+            self.remaining -= 1
+            self.profiled += 1
+            return self.profiled
+
+    @contextmanager
+    def profile(self, label):
+        number = self._take() if self.remaining else None
+        if number is None:
+            yield
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{number}-{label}")
+        sampler = StackSampler(self.stack_interval)
+        sampler.start()
+        try:
+            with torch.autograd.profiler.profile(record_shapes=True) as prof:
+                yield
+        finally:
+            sampler.stop()
+
+        prof.export_chrome_trace(base + ".trace.json")
+        with open(base + ".ops.txt", "w") as f:
+            f.write(prof.key_averages(group_by_input_shape=True).table(sort_by="self_cpu_time_total"))
+        sampler.write(base + ".stacks.txt")
+        print(f"Profile of a {label} written to {base}.*")
+
+
+class SlowRequestLog:
+    """
+    Writes a JSON line for every request that took at least `threshold_ms`, to the file at
+    `path` or else to standard output. Lines are appended with a single write, so all uwsgi
+    workers can share the file.
+    """
+    def __init__(self, threshold_ms, path=""):
+        self.threshold_ms = threshold_ms
+        self.path = path
+
+    def is_slow(self, seconds):
+        return self.threshold_ms > 0 and seconds * 1000 >= self.threshold_ms
+
+    def write(self, entry):
+        line = json.dumps(entry)
+        if not self.path:
+            print(f"Slow request: {line}")
+            return
+        with open(self.path, "a") as f:
+            f.write(line + "\n")
@@ -0,0 +1,159 @@
+"""
+Dynamic micro-batching for the SDG webservice
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from concurrent.futures import Future
+import itertools
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+def add_to_trace(trace, key, value):
+    if trace is not None:
+        trace[key] = trace.get(key, 0) + value
+
+
+class InferenceScheduler:
+    """
+    Gathers the texts of all in-flight requests into shared batches. As soon as a request comes
+    in the scheduler waits at most `max_wait` seconds for other requests to join, or until
+    `max_batch_size` texts have been collected.
+
+    Inference runs as a two-stage pipeline on long-lived threads: the first stage collects
+    requests and calls `prepare` on their texts (tokenization and batching), the second calls
+    `run` on the prepared input (the forward pass), which must return one row of scores per text.
+    While the model runs on one set of requests, the next set is already being tokenized. Every
+    request gets its own slice of the scores back through a Future.
+
+    Requests with a lower `priority` number are collected first, so interactive requests can
+    overtake queued background work. When given, `on_wait` is called with the time in seconds
+    every request waited in the queue before its texts were prepared.
+
+    A request can pass a `trace` dict, to which the scheduler adds the seconds it spent in every
+    stage ("queue_wait", "prepare" and "run", for the whole shared batch) and the number of texts
+    of the batches it was part of ("batch_texts").
+    """
+    def __init__(self, prepare, run, max_batch_size, max_wait, on_wait=None):
+        self.prepare = prepare
+        self.run = run
+        self.on_wait = on_wait
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.threads = []
+        self.pid = None
+        self.start_lock = threading.Lock()
+        self.sequence = itertools.count()
+
+    def submit(self, texts, priority=0, trace=None):
+        """
+        Queues a list of texts for inference and returns a Future for their scores
+        """
+        future = Future()
+        if not texts:
+            future.set_result(np.zeros((0, 17), dtype=np.float32))
+            return future
+
+        self._ensure_running()
+        self.queue.put((priority, next(self.sequence), list(texts), future, time.monotonic(), trace))
+        return future
+
+    def _ensure_running(self):
+        # The threads are started lazily (and restarted after a fork), so the scheduler also
+        # works when the app is loaded before uwsgi forks its workers.
+        with self.start_lock:
+            if self.pid != os.getpid() or not all(thread.is_alive() for thread in self.threads):
+                self.queue = queue.PriorityQueue()
+                # Holding one prepared set of requests is enough to keep the forward stage busy
+                prepared = queue.Queue(maxsize=1)
+                self.pid = os.getpid()
+                self.threads = [
+                    threading.Thread(target=self._prepare_stage, args=(self.queue, prepared), daemon=True),
+                    threading.Thread(target=self._run_stage, args=(prepared,), daemon=True),
+                ]
+                for thread in self.threads:
+                    thread.start()
+
+    def _collect(self, requests):
+        pending = [requests.get()[2:]]
+        num_texts = len(pending[0][0])
+        deadline = time.monotonic() + self.max_wait
+
+        while num_texts < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(item[2:])
+            num_texts += len(item[2])
+
+        return pending
+
+    def _prepare_stage(self, requests, prepared):
+        while True:
+            collected = self._collect(requests)
+            now = time.monotonic()
+            for _, _, queued, trace in collected:
+                if self.on_wait is not None:
+                    self.on_wait(now - queued)
+                add_to_trace(trace, "queue_wait", now - queued)
+            pending = [
+                (texts, future, trace) for texts, future, _, trace in collected
+                if future.set_running_or_notify_cancel()
+            ]
+            if not pending:
+                continue
+
+            texts = [text for request_texts, _, _ in pending for text in request_texts]
+            try:
+                inputs = self.prepare(texts)
+            except Exception as e:
+                for _, future, _ in pending:
+                    future.set_exception(e)
+                continue
+
+            for _, _, trace in pending:
+                add_to_trace(trace, "prepare", time.monotonic() - now)
+                add_to_trace(trace, "batch_texts", len(texts))
+            prepared.put((pending, inputs))
+
+    def _run_stage(self, prepared):
+        while True:
+            pending, inputs = prepared.get()
+            start = time.monotonic()
+            try:
+                outs = self.run(inputs)
+            except Exception as e:
+                for _, future, _ in pending:
+                    future.set_exception(e)
+                continue
+
+            for _, _, trace in pending:
+                add_to_trace(trace, "run", time.monotonic() - start)
+            start = 0
+            for request_texts, future, _ in pending:
+                future.set_result(outs[start:start + len(request_texts)])
+                start += len(request_texts)
@@ -0,0 +1,87 @@
+
+"""
+SDG model network (BERT encoder with the SDG classification head)
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import torch
+import torch.nn as nn
+from transformers import BertPreTrainedModel, BertModel
+
+
+class SDGModel(BertPreTrainedModel):
+    def __init__(self, conf):
+        super(SDGModel, self).__init__(conf)
+        self.bert = BertModel(conf)
+        self.drop_out = nn.Dropout(0.1)
+
+
+        self.nb_features = self.bert.pooler.dense.out_features
+
+        self.pooler = nn.Sequential(
+            nn.Linear(self.nb_features * 2, self.nb_features),
+            nn.Tanh(),
+        )
+
+        self.logit = nn.Linear(self.nb_features, 17)
+
+        torch.nn.init.normal_(self.logit.weight, std=0.02)
+
+    def cls_features(self, ids, mask, token_type_ids, position_ids=None, cls_index=None):
+        """
+        Runs the BERT encoder layer by layer and returns the CLS vectors of the last two layers.
+        Unlike calling self.bert with output_hidden_states, this does not keep every layer's
+        hidden states in memory and skips the BERT pooler, whose output is not used.
+
+        For packed sequences (see prepare_packed_batches) the mask is a batch x tokens x tokens
+        block-diagonal matrix, so every text only attends to its own tokens, position_ids restart
+        at 0 for every text, and cls_index holds the batch row and the position of the [CLS]
+        token of every text; one row of features is returned per text.
+        """
+        if mask.dim() == 3:
+            extended_mask = mask[:, None, :, :]
+        else:
+            extended_mask = mask[:, None, None, :]
+        extended_mask = extended_mask.to(dtype=next(self.bert.parameters()).dtype)
+        extended_mask = (1.0 - extended_mask) * -10000.0
+
+        hidden_states = self.bert.embeddings(input_ids=ids, token_type_ids=token_type_ids, position_ids=position_ids)
+        for layer in self.bert.encoder.layer[:-1]:
+            hidden_states = layer(hidden_states, extended_mask)[0]
+        second_to_last = hidden_states
+        hidden_states = self.bert.encoder.layer[-1](hidden_states, extended_mask)[0]
+
+        if cls_index is None:
+            return torch.cat((hidden_states[:, 0], second_to_last[:, 0]), dim=-1)
+        rows, positions = cls_index
+        return torch.cat((hidden_states[rows, positions], second_to_last[rows, positions]), dim=-1)
+
+    def head(self, features):
+        """
+        The classification head: turns the features returned by cls_features into logits.
+        """
+        out = self.drop_out(features)
+        out = self.pooler(out)
+
+        logits = self.logit(out)
+
+
+        return logits
+
+    def forward(self, ids, mask, token_type_ids):
+        return self.head(self.cls_features(ids, mask, token_type_ids))
@@ -22,9 +22,14 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 import warnings
 warnings.filterwarnings('ignore')
 
+import inspect
+import json
+import numpy as np
+import os
+import time
 import torch
+import zipfile
 import torch.nn as nn
-from transformers import BertPreTrainedModel, BertModel, BertConfig
 import tokenizers
 import config
 
@@ -32,7 +37,7 @@ class SDGconfig:
     MAX_LEN = 512
     VALID_BATCH_SIZE = 16
     MODEL_PATH = config.MODEL_PATH,
-    BERT_PATH = 'bert-base-uncased'
+    BERT_CONFIG_PATH = config.CONFIG_PATH
     TOKENIZER = tokenizers.BertWordPieceTokenizer(
         config.VOCAB_PATH,
         lowercase=True
@@ -68,59 +73,313 @@ def process_data(abstract,tokenizer, max_len):
 
     }
 
-class SDGDataset:
-    def __init__(self, abstract):
-        self.abstract = abstract
-        self.tokenizer = SDGconfig.TOKENIZER
-        self.max_len = SDGconfig.MAX_LEN
-
-    def __len__(self):
-        return len(self.abstract)
-
-    def __getitem__(self, item):
-        data = process_data(
-            self.abstract[item],
-            self.tokenizer,
-            self.max_len
-        )
-
-        return {
-            'ids': torch.tensor(data["ids"], dtype=torch.long),
-            'mask': torch.tensor(data["mask"], dtype=torch.long),
-            'token_type_ids': torch.tensor(data["token_type_ids"], dtype=torch.long)
-        }
-
-
-class SDGModel(BertPreTrainedModel):
-    def __init__(self, conf):
-        super(SDGModel, self).__init__(conf)
-        self.bert = BertModel.from_pretrained(SDGconfig.BERT_PATH, config=conf)
-        self.drop_out = nn.Dropout(0.1)
-
-
-        self.nb_features = self.bert.pooler.dense.out_features
-
-        self.pooler = nn.Sequential(
-            nn.Linear(self.nb_features * 2, self.nb_features),
-            nn.Tanh(),
-        )
-
-        self.logit = nn.Linear(self.nb_features, 17)
-
-        torch.nn.init.normal_(self.logit.weight, std=0.02)
-
-    def forward(self, ids, mask, token_type_ids):
-        last_hidden_state ,pooler_output , hidden_states = self.bert(
-            ids,
-            attention_mask=mask,
-            token_type_ids=token_type_ids
-        )
-        out = torch.cat((hidden_states[-1][:, 0], hidden_states[-2][:, 0]), dim=-1)
-
-        out = self.drop_out(out)
-        out = self.pooler(out)
-
-        logits = self.logit(out)
-
-
-        return logits
+def restore_order(outs, order):
+    """
+    Undo the permutation applied by prepare_batches: outs[i] belongs to input order[i].
+    """
+    restored = np.empty_like(outs)
+    restored[order] = outs
+    return restored
+
+
+def batch_size_for(length, batch_size, batch_sizes=None):
+    """
+    The batch size for texts of up to `length` tokens: that of the shortest tuned length that
+    holds them (batch_sizes maps sequence lengths to batch sizes, see autotune.py), else batch_size
+    """
+    tuned = [size for tuned_length, size in sorted((batch_sizes or {}).items()) if length <= tuned_length]
+    return tuned[0] if tuned else batch_size
+
+
+def prepare_batches(texts, batch_size, dynamic_padding=True, batch_sizes=None):
+    """
+    Tokenizes all texts with a single batch encoding call and groups them into batches of padded
+    tensors. With dynamic padding the texts are sorted by token length and every batch is only
+    padded to its longest text, otherwise texts keep their order and are padded to MAX_LEN. With
+    batch_sizes (see batch_size_for) the size of every batch depends on the length it is padded
+    to, so batches of short texts hold more texts. Returns the batches and the input index of
+    every row in them (see restore_order).
+    """
+    encodings = SDGconfig.TOKENIZER.encode_batch(list(texts))
+    input_ids = [encoding.ids[:SDGconfig.MAX_LEN] for encoding in encodings]
+
+    if dynamic_padding:
+        # The longest texts come first, so that memory problems surface on the first batch
+        order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]), reverse=True)
+    else:
+        order = list(range(len(input_ids)))
+
+    batches = []
+    start = 0
+    while start < len(order):
+        # With dynamic padding the first text of a batch is its longest
+        max_len = len(input_ids[order[start]]) if dynamic_padding else SDGconfig.MAX_LEN
+        end = start + batch_size_for(max_len, batch_size, batch_sizes)
+        batch_ids = [input_ids[i] for i in order[start:end]]
+        start = end
+
+        ids = torch.zeros((len(batch_ids), max_len), dtype=torch.long)
+        mask = torch.zeros((len(batch_ids), max_len), dtype=torch.long)
+        for row, token_ids in enumerate(batch_ids):
+            ids[row, :len(token_ids)] = torch.tensor(token_ids, dtype=torch.long)
+            mask[row, :len(token_ids)] = 1
+
+        # As in process_data, the token type is 1 for every real token and 0 for padding
+        batches.append({'ids': ids, 'mask': mask, 'token_type_ids': mask.clone()})
+
+    return batches, order
+
+
+def pack_sequences(lengths, max_len):
+    """
+    Groups texts into sequences of at most max_len tokens (first fit, longest texts first).
+    Texts longer than max_len get a sequence of their own. Returns the text indices of every
+    sequence.
+    """
+    sequences = []
+    free = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        for sequence, space in enumerate(free):
+            if lengths[i] <= space:
+                sequences[sequence].append(i)
+                free[sequence] -= lengths[i]
+                break
+        else:
+            sequences.append([i])
+            free.append(max_len - lengths[i])
+    return sequences
+
+
+def prepare_packed_batches(texts, batch_size, max_len=SDGconfig.MAX_LEN):
+    """
+    Like prepare_batches, but packs several (short) texts into every sequence of up to max_len
+    tokens, so that batches of titles or abstracts hold little padding. Every text keeps its own
+    [CLS] and [SEP] tokens and position ids starting at 0, and the attention mask is block-diagonal
+    (batch x tokens x tokens), so a text only attends to itself and scores (nearly) the same as
+    when it is run on its own. Every batch holds batch_size sequences and is padded to its
+    longest sequence; cls_index holds the batch row and position of the [CLS] token of every text.
+    """
+    encodings = SDGconfig.TOKENIZER.encode_batch(list(texts))
+    input_ids = [encoding.ids[:SDGconfig.MAX_LEN] for encoding in encodings]
+    sequences = pack_sequences([len(ids) for ids in input_ids], max_len)
+    order = [i for sequence in sequences for i in sequence]
+
+    batches = []
+    for start in range(0, len(sequences), batch_size):
+        batch_sequences = sequences[start:start + batch_size]
+        length = max(sum(len(input_ids[i]) for i in sequence) for sequence in batch_sequences)
+
+        ids = torch.zeros((len(batch_sequences), length), dtype=torch.long)
+        position_ids = torch.zeros((len(batch_sequences), length), dtype=torch.long)
+        token_type_ids = torch.zeros((len(batch_sequences), length), dtype=torch.long)
+        mask = torch.zeros((len(batch_sequences), length, length), dtype=torch.uint8)
+        cls_rows = []
+        cls_positions = []
+        for row, sequence in enumerate(batch_sequences):
+            offset = 0
+            for i in sequence:
+                end = offset + len(input_ids[i])
+                ids[row, offset:end] = torch.tensor(input_ids[i], dtype=torch.long)
+                position_ids[row, offset:end] = torch.arange(end - offset)
+                token_type_ids[row, offset:end] = 1
+                mask[row, offset:end, offset:end] = 1
+                cls_rows.append(row)
+                cls_positions.append(offset)
+                offset = end
+
+        batches.append({
+            'ids': ids, 'mask': mask, 'token_type_ids': token_type_ids, 'position_ids': position_ids,
+            'cls_index': torch.tensor([cls_rows, cls_positions], dtype=torch.long)
+        })
+
+    return batches, order
+
+
+def run_batches(model, batches, order, device, return_features=False):
+    """
+    Runs the model over batches made by prepare_batches (or prepare_packed_batches) and returns
+    the SDG probabilities, one row per text in input order. With return_features the CLS features
+    the classification head scores (see SDGModel.cls_features) are returned as well, as
+    (probabilities, features). Both packed batches and features need an SDGModel, not a
+    TorchScript export.
+    """
+    outs = []
+    features = []
+    with torch.no_grad():
+        for d in batches:
+            ids = d["ids"].to(device, dtype=torch.long)
+            token_type_ids = d["token_type_ids"].to(device, dtype=torch.long)
+            mask = d["mask"].to(device, dtype=torch.long)
+
+            if "cls_index" in d:
+                cls = model.cls_features(
+                    ids, mask, token_type_ids, d["position_ids"].to(device), d["cls_index"].to(device)
+                )
+                preds = model.head(cls)
+            elif return_features:
+                cls = model.cls_features(ids, mask, token_type_ids)
+                preds = model.head(cls)
+            else:
+                preds = model(ids, mask, token_type_ids)
+            if return_features:
+                features.append(cls.cpu().numpy())
+
+            outs.append(torch.sigmoid(preds).cpu().detach().numpy())
+
+    if not outs:
+        outs = np.zeros((0, 17), dtype=np.float32)
+        return (outs, np.zeros((0, 0), dtype=np.float32)) if return_features else outs
+    outs = restore_order(np.vstack(outs), order)
+    if return_features:
+        return outs, restore_order(np.vstack(features), order)
+    return outs
+
+
+def predict(model, texts, device, batch_size, dynamic_padding=True, packing_max_len=0):
+    """
+    Runs the model over a list of texts and returns the SDG probabilities (one row per text,
+    in input order). With packing_max_len texts are packed into sequences of that many tokens.
+    """
+    if packing_max_len:
+        batches, order = prepare_packed_batches(texts, batch_size, packing_max_len)
+    else:
+        batches, order = prepare_batches(texts, batch_size, dynamic_padding)
+    return run_batches(model, batches, order, device)
+
+
+# Short texts touching on different SDGs, used to compare a quantized model with the original
+PROBE_TEXTS = [
+    "Globally, the number of people living in extreme poverty declined from 36 per cent in 1990 to 10 per cent in 2015.",
+    "Education enables upward socioeconomic mobility and is a key to escaping poverty. Over the past decade, major progress was made towards increasing access to education and school enrollment rates at all levels, particularly for girls.",
+    "Stunting among children under five is associated with food insecurity, low agricultural productivity and poor access to nutritious diets.",
+    "We estimate the effect of malaria prevention programmes on child mortality and maternal health in sub-Saharan Africa.",
+    "Access to safely managed drinking water and sanitation services remains limited in rural areas.",
+    "Rooftop solar panels and wind power reduce greenhouse gas emissions and improve access to affordable clean energy.",
+    "Bottom trawling destroys deep sea coral forests and causes large bycatch of non target species in the ocean.",
+    "Deforestation and land degradation threaten biodiversity and the livelihoods of forest communities.",
+    "Anti-corruption institutions and independent courts strengthen the rule of law and access to justice.",
+    "The gender pay gap persists, and women remain underrepresented in managerial positions and parliaments.",
+]
+
+
+def quantize_model(model):
+    """
+    Returns a copy of the model in which all Linear layers are dynamically quantized to int8.
+    Quantized models only run on the CPU.
+    """
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def max_score_deviation(reference, candidate, device, texts=PROBE_TEXTS):
+    """
+    Returns the maximum absolute difference per SDG between the scores of two models on a set
+    of probe texts
+    """
+    reference_scores = predict(reference, texts, device, SDGconfig.VALID_BATCH_SIZE)
+    candidate_scores = predict(candidate, texts, device, SDGconfig.VALID_BATCH_SIZE)
+    return np.abs(reference_scores - candidate_scores).max(axis=0)
+
+
+def max_packing_deviation(model, device, max_len, texts=PROBE_TEXTS):
+    """
+    Returns the maximum absolute difference per SDG between the scores of packed and unpacked
+    inference on a set of probe texts
+    """
+    unpacked = predict(model, texts, device, SDGconfig.VALID_BATCH_SIZE)
+    packed = predict(model, texts, device, SDGconfig.VALID_BATCH_SIZE, packing_max_len=max_len)
+    return np.abs(unpacked - packed).max(axis=0)
+
+
+def load_state_dict(path, device):
+    """
+    Loads the fine-tuned weights from a training checkpoint. When the installed torch supports
+    it and the checkpoint uses the zip format, the file is memory-mapped instead of read into
+    memory, so the optimizer state stored alongside the weights is never materialised.
+    """
+    kwargs = {'map_location': device}
+    if 'mmap' in inspect.signature(torch.load).parameters and zipfile.is_zipfile(path):
+        kwargs['mmap'] = True
+    checkpoint = torch.load(path, **kwargs)
+    return checkpoint['model_state_dict']
+
+
+def checkpoint_identity(path):
+    """
+    Identifies a checkpoint by its file name, size and modification time. An export records the
+    identity of the checkpoint it was made from (load_torchscript_model in
+    sdg-large-text-corpora/sdg_util.py compares it in the same way).
+    """
+    stat = os.stat(path)
+    return {'file': os.path.basename(path), 'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+def load_torchscript_model(path, device, precision, checkpoint_path):
+    """
+    Loads a model exported by export_torchscript.py. Returns None when the file was exported
+    for another precision or device type than requested, or from another checkpoint than the
+    one at checkpoint_path.
+    """
+    start = time.perf_counter()
+    extra_files = {'metadata': ''}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    metadata = extra_files['metadata']
+    metadata = json.loads(metadata.decode() if isinstance(metadata, bytes) else metadata)
+
+    if metadata['precision'] != precision or metadata['device'] != torch.device(device).type:
+        print(f"Not using TorchScript model {path}: it was exported for {metadata['precision']} on "
+              f"{metadata['device']}, not {precision} on {torch.device(device).type}")
+        return None
+    if metadata.get('checkpoint') != checkpoint_identity(checkpoint_path):
+        print(f"Not using TorchScript model {path}: it was exported from {metadata.get('checkpoint')}, "
+              f"not from {checkpoint_path}; run export_torchscript.py again")
+        return None
+
+    model.eval()
+    print(f"TorchScript model loaded in {time.perf_counter() - start:.2f}s")
+    return model
+
+
+def load_model(device, precision='fp32', check_precision=True, torchscript=True):
+    """
+    Builds SDGModel from the bundled BERT config (so no pretrained bert-base-uncased weights are
+    downloaded or loaded only to be overwritten) and loads the fine-tuned weights once.
+    With precision 'int8' the Linear layers are dynamically quantized; when check_precision is
+    set, the deviation of the quantized scores from the fp32 scores on PROBE_TEXTS is printed.
+    When torchscript is set and an export of config.MODEL_PATH with the same precision exists at
+    config.TORCHSCRIPT_PATH, that is loaded instead (which does not require importing transformers).
+    """
+    if precision not in ('fp32', 'int8'):
+        raise ValueError("unsupported precision %s (use fp32 or int8)" % precision)
+    if precision == 'int8' and torch.device(device).type != 'cpu':
+        raise ValueError("int8 precision is only supported on the CPU")
+
+    if torchscript and config.TORCHSCRIPT_PATH and os.path.exists(config.TORCHSCRIPT_PATH):
+        model = load_torchscript_model(config.TORCHSCRIPT_PATH, device, precision, config.MODEL_PATH)
+        if model is not None:
+            return model
+
+    from sdg_bert import SDGModel
+    from transformers import BertConfig
+
+    start = time.perf_counter()
+    model_config = BertConfig.from_json_file(SDGconfig.BERT_CONFIG_PATH)
+    model = SDGModel(conf=model_config)
+    built = time.perf_counter()
+
+    model.load_state_dict(load_state_dict(config.MODEL_PATH, device))
+    model.eval()
+    model.to(device)
+    loaded = time.perf_counter()
+
+    print(f"Model loaded in {loaded - start:.2f}s (build {built - start:.2f}s, weights {loaded - built:.2f}s)")
+
+    if precision == 'int8':
+        quantized = quantize_model(model)
+        print(f"Model quantized to int8 in {time.perf_counter() - loaded:.2f}s")
+        if check_precision:
+            deviation = max_score_deviation(model, quantized, device)
+            print("Maximum score deviation from fp32 per SDG: " + ", ".join(
+                f"sdg{i + 1}={value:.4f}" for i, value in enumerate(deviation)))
+        model = quantized
+
+    return model
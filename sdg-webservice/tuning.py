@@ -0,0 +1,75 @@
+"""
+The tuned settings that autotune.py writes: the format of the file and the hardware it applies to
+
+This module only needs torch, so the corpus scripts in sdg-large-text-corpora import it from here
+as well (index_corpus.py --autotune-file, for a single worker).
+
+The file holds:
+* torch_threads: the torch (intra-op) threads per worker
+* batch_sizes: the batch size per sequence length, as {"64": 64, ..., "512": 8}; a batch of texts
+  of up to that many tokens (including [CLS] and [SEP]) holds that many texts
+* batch_size: the batch size of the longest length, for batches that are padded to it
+* hardware: see hardware(), for the given number of uwsgi workers
+* precision: the precision of the model that was measured (fp32 or int8)
+A file is only used when its hardware and precision are exactly those of the process that reads
+it (see load_tuned).
+
+Authors:
+* Nick Jelicic (Dialogic)
+* Tommy van der Vorst (Dialogic)
+* Wilfred Mijnhardt (Rotterdam School of Management)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import json
+import os
+import platform
+
+import torch
+
+
+def available_cores():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def hardware(device_type, workers=1):
+    """
+    Describes what the tuned configuration depends on
+    """
+    description = {
+        "cores": available_cores(),
+        "machine": platform.machine(),
+        "device": device_type,
+        "workers": workers,
+    }
+    if device_type == 'cuda':
+        description["gpu"] = torch.cuda.get_device_name(0)
+    return description
+
+
+def load_tuned(path, device_type, precision, workers=1):
+    """
+    Returns the configuration in an autotune file when it was made for this hardware and
+    precision, else None
+    """
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        tuned = json.load(f)
+    if tuned.get("hardware") != hardware(device_type, workers):
+        print(f"Not using {path}: it was tuned for {tuned.get('hardware')}")
+        return None
+    if tuned.get("precision") != precision:
+        print(f"Not using {path}: it was tuned for precision {tuned.get('precision')}, not {precision}")
+        return None
+    return tuned